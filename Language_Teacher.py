@@ -1,13 +1,18 @@
 import streamlit as st
-from sqlmodel import SQLModel
 
 from src.anki import CardCategory
-from src.db import engine, get_cards_next_cards
+from src.audio import AudioClip, migrate_audio_to_store  # noqa: F401
+from src.db import get_cards, get_due_card_ids, get_due_counts, init_db
 from src.llm import ModelUsage  # noqa: F401
+from src.llm_budget import UsageRollup, backfill_rollups  # noqa: F401
+from src.llm_cache import LLMCacheEntry  # noqa: F401
+from src.llm_telemetry import LLMCall  # noqa: F401
 from src.plans.plan import ExercisePlan  # noqa: F401
 from src.tasks import VocabTask
 
-SQLModel.metadata.create_all(engine)
+init_db()
+migrate_audio_to_store()
+backfill_rollups()
 
 
 st.set_page_config(page_title="Anki App", layout="wide")
@@ -41,13 +46,21 @@ with center:
         st.session_state.select_category = st.selectbox(
             "Select Card Category", category_options
         )
-        cards_left = get_cards_next_cards(category=st.session_state.select_category)
-        st.write(f"Cards to review: {len(cards_left)}")
+        due_counts = get_due_counts()
+        n_cards_left = (
+            sum(due_counts.values())
+            if st.session_state.select_category == "All"
+            else due_counts.get(st.session_state.select_category, 0)
+        )
+        st.write(f"Cards to review: {n_cards_left}")
         start_new = st.button("Start a Learn Session")
 
         if start_new:
+            card_ids = get_due_card_ids(
+                category=st.session_state.select_category, limit=MAX_SESSION_NUMBER
+            )
             st.session_state.current_task = VocabTask(
-                id=-1, title="", suptitle="", cards=cards_left[:MAX_SESSION_NUMBER]
+                id=-1, title="", suptitle="", cards=get_cards(card_ids)
             )
             st.rerun()
     else:
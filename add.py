@@ -1,8 +1,7 @@
 from sqlmodel import Session, select
-from tqdm import tqdm
 
 from src.anki import AnkiCard, CardCategory
-from src.audio import add_audios_inplance
+from src.audio import add_audios_batch
 from src.db import engine
 
 cards = [
@@ -152,7 +151,8 @@ cards = [
     },
 ]
 with Session(engine) as session:
-    for c in tqdm(cards):
+    objs = []
+    for c in cards:
         # Try to find existing card by a_content and b_content
         # Delete all existing cards with same a_content and b_content
         stmt = select(AnkiCard).where(
@@ -160,12 +160,14 @@ with Session(engine) as session:
         )
         for existing in session.exec(stmt).all():
             session.delete(existing)
-        obj = AnkiCard(
-            a_content=c["a_content"],
-            b_content=c["b_content"],
-            category=c["category"],
-            notes=c["notes"],
+        objs.append(
+            AnkiCard(
+                a_content=c["a_content"],
+                b_content=c["b_content"],
+                category=c["category"],
+                notes=c["notes"],
+            )
         )
-        add_audios_inplance(obj)
-        session.add(obj)
+    add_audios_batch(objs)
+    session.add_all(objs)
     session.commit()
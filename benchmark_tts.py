@@ -0,0 +1,70 @@
+"""
+Compares the TTS backends: per-clip latency (serial) and throughput (concurrent,
+using each backend's own worker and rate limits).
+
+    python benchmark_tts.py --backends gtts espeak-ng --n-clips 40
+"""
+
+import argparse
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from src.audio import RateLimiter
+from src.tts import BACKENDS, get_backend
+
+WORDS = [
+    ("dar", "es"),
+    ("geben", "de"),
+    ("parecerse a", "es"),
+    ("aussehen wie, ähneln", "de"),
+    ("Me levanto temprano los lunes.", "es"),
+    ("Ich stehe montags früh auf.", "de"),
+    ("después de", "es"),
+    ("definitivamente", "es"),
+]
+
+
+def bench(name: str, n_clips: int) -> None:
+    try:
+        backend = get_backend(name)
+        backend.synthesize(*WORDS[0], timeout=10)  # warm up
+    except Exception as e:
+        print(f"{name:>10}: unavailable ({e})")
+        return
+
+    jobs = [WORDS[i % len(WORDS)] for i in range(n_clips)]
+
+    latencies = []
+    for text, lang in jobs[: min(len(jobs), 10)]:
+        start = time.perf_counter()
+        backend.synthesize(text, lang, timeout=10)
+        latencies.append(time.perf_counter() - start)
+
+    limiter = RateLimiter(backend.max_per_second)
+
+    def synthesize(job):
+        limiter.wait()
+        return backend.synthesize(*job, timeout=10)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=backend.max_workers) as pool:
+        clips = list(pool.map(synthesize, jobs))
+    elapsed = time.perf_counter() - start
+
+    print(
+        f"{name:>10}: p50 {statistics.median(latencies) * 1000:7.1f} ms/clip, "
+        f"max {max(latencies) * 1000:7.1f} ms/clip, "
+        f"{len(clips) / elapsed:6.1f} clips/s with {backend.max_workers} workers, "
+        f"{sum(map(len, clips)) / len(clips) / 1024:5.1f} KiB/clip"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--backends", nargs="+", default=list(BACKENDS))
+    parser.add_argument("--n-clips", type=int, default=40)
+    args = parser.parse_args()
+
+    for name in args.backends:
+        bench(name, args.n_clips)
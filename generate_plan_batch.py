@@ -0,0 +1,24 @@
+"""
+Generates the tasks of a study plan through the Gemini Batch API and saves the
+plan, see `generate_and_save`. Cheaper than the app, but it can take hours; an
+interrupted run resumes its submitted batch job.
+
+    python generate_plan_batch.py study_plan.json
+"""
+
+import argparse
+from pathlib import Path
+
+from src.db import init_db
+from src.plans.generate_and_save import generate_and_save
+from src.plans.planning import StudyPlan
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("plan", type=Path, nargs="?", default=Path("study_plan.json"))
+    parser.add_argument("--n-retries", type=int, default=3)
+    args = parser.parse_args()
+
+    init_db()
+    plan = StudyPlan.model_validate_json(args.plan.read_text())
+    generate_and_save(plan, n_retries=args.n_retries, batch=True)
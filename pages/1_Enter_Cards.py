@@ -1,17 +1,34 @@
-import json
+import itertools
+import threading
+from typing import Any, Iterator, Optional
 
 import markdown
 import streamlit as st
 from google.genai import types
 from loguru import logger
-from pdf2image import convert_from_bytes
 from pydantic import BaseModel, Field
 from streamlit import session_state as state
-from tqdm import tqdm
 
-from src.anki import CardCategory, SimpleAnkiCard
-from src.db import add_card
-from src.llm import gemini_structured_ouput
+from src.anki import AnkiCard, CardCategory, SimpleAnkiCard
+from src.audio import add_audios_batch
+from src.card_context import (
+    card_delta,
+    summarize_chat,
+    summary_content,
+    summary_cut,
+)
+from src.card_extraction import (
+    deck_fronts,
+    dedupe_cards,
+    document_chunks,
+    extract_cards_async,
+)
+from src.db import add_cards
+from src.json_stream import JSONStreamParser
+from src.llm import gemini_stream_async, iterate_sync
+from src.media import media_registry
+from src.thumbnails import thumbnail_cache
+from src.uploads import upload_digest
 
 
 class ModelAction(BaseModel):
@@ -34,18 +51,22 @@ User Spanish Level: Beginner
 You will get messages and images, according to which you should help the user to
 add, update or delete there current Anki cards. 
 
-The currents cards are:
-{cards_string}
-
-It is important to undestand that above cards are always up to date! 
+With every user message you get the cards that were added, changed or deleted
+since your last reply, and the ids of all current cards. A card you have not
+seen changed is still as it was last shown to you.
+It is important to undestand that these cards are always up to date! 
 """
 
 
 def to_gemini_content(history: list) -> list:
     contents = []
+    media_seen = set()
+    media_registry.prefetch_uploads(
+        content for content, speaker in history if speaker == "image"
+    )
 
     for content, speaker in history:
-        if speaker == "user":
+        if speaker in ("user", "cards"):
             contents.append(
                 types.Content(role="user", parts=[types.Part(text=content)])
             )
@@ -54,13 +75,11 @@ def to_gemini_content(history: list) -> list:
                 types.Content(role="model", parts=[types.Part(text=content)])
             )
         elif speaker == "image":
-            ext = content.name.split(".")[-1].lower().replace("jpg", "jpeg")
-            contents.append(
-                types.Part.from_bytes(
-                    data=content.read(),
-                    mime_type="application/pdf" if ext == "pdf" else f"image/{ext}",
-                )
-            )
+            # the same file uploaded twice is only sent once
+            digest = upload_digest(content)
+            if digest not in media_seen:
+                media_seen.add(digest)
+                contents.extend(media_registry.upload_parts(content))
 
         else:
             raise ValueError("not implemented")
@@ -86,44 +105,193 @@ if "images" not in state:
 if "current_cards" not in state:
     state.current_cards = {}
 
-
-def get_reply(history) -> str:
-    content = to_gemini_content(history=history)
-    cards_string = json.dumps(
-        [card.model_dump() for _, card in state.current_cards.items()], indent=4
+if "cards_lock" not in state:
+    # a running reply job changes current_cards from its thread
+    state.cards_lock = threading.Lock()
+    # ids are never reused, so a new card never takes over the widgets of another
+    state.card_ids = itertools.count(max(state.current_cards, default=0) + 1)
+    state.empty_card_id = next(state.card_ids)
+
+
+if "reply_job" not in state:
+    state.reply_job = None
+
+# the model's view of the chat: the cards as it last got them, and a summary
+# of state.chat[:summarized_upto]
+if "sent_cards" not in state:
+    state.sent_cards = {}
+    state.summary = None
+    state.summarized_upto = 0
+
+
+class ReplyJob:
+    """
+    Streams the model's reply in a background thread, so card rows stay editable
+    while it is generated. Every card action is applied to `cards`, under
+    `lock`, as soon as its JSON is complete; new cards get ids from `card_ids`.
+    """
+
+    def __init__(
+        self,
+        system_prompt: str,
+        contents: list,
+        cards: dict,
+        lock: threading.Lock,
+        card_ids: Iterator[int],
+        summary: Optional[str] = None,
+        to_summarize: Optional[list] = None,
+        summarize_upto: Optional[int] = None,
+    ):
+        self.cards = cards
+        self.lock = lock
+        self.card_ids = card_ids
+        self.message = ""
+        self.n_actions = 0
+        self.reply: Optional[str] = None
+        self.summary = summary
+        self.summarize_upto = summarize_upto
+        self.summarized = False
+        self.done = False
+        threading.Thread(
+            target=self._run, args=(system_prompt, contents, to_summarize), daemon=True
+        ).start()
+
+    def _run(
+        self, system_prompt: str, contents: list, to_summarize: Optional[list]
+    ) -> None:
+        parser = JSONStreamParser()
+        try:
+            if to_summarize:
+                summary = summarize_chat(self.summary, to_summarize)
+                self.summarized = summary is not None
+                if self.summarized:
+                    self.summary = summary
+                else:
+                    contents = to_summarize + contents
+            if self.summary:
+                contents = [summary_content(self.summary), *contents]
+
+            for chunk in iterate_sync(
+                gemini_stream_async(
+                    system_prompt=system_prompt,
+                    contents=contents,
+                    Schema=ModelAction,
+                    model_name="gemini-2.5-flash-preview-05-20",
+                    disable_thinking=True,
+                    call_site="card_chat",
+                )
+            ):
+                for key, item in parser.feed(chunk):
+                    self._apply(key, item)
+                self.message = parser.partial_string("message_to_user") or ""
+            logger.debug(f"Got Response:\n{parser.text}")
+            self.reply = parser.fields["message_to_user"]
+        except Exception as e:
+            logger.exception(f"Model Answer failed {e}")
+            self.reply = "Something wen't wrong. Try again."
+        finally:
+            self.done = True
+
+    def _apply(self, key: str, item: Any) -> None:
+        with self.lock:
+            if key == "cards_to_add":
+                card = SimpleAnkiCard.model_validate(item)
+                card.id = next(self.card_ids)
+                self.cards[card.id] = card
+            elif key == "cards_to_update":
+                card = SimpleAnkiCard.model_validate(item)
+                if card.id not in self.cards:
+                    logger.warning(f"{card.id} not in cards")
+                    return
+                logger.debug(f"upadatating {card.model_dump_json(indent=4)}")
+                self.cards[card.id] = card
+            elif key == "cards_to_delete":
+                self.cards.pop(item, None)
+        self.n_actions += 1
+
+
+def get_reply(history) -> ReplyJob:
+    """
+    Sends the chat since the last summary and only the cards that changed since
+    the model's last turn. A too long chat is summarized first.
+    """
+    cut = summary_cut(len(history), state.summarized_upto)
+    to_summarize = None
+    if cut is not None:
+        to_summarize = to_gemini_content(history[state.summarized_upto : cut])
+        # the card changes in the summarized part are lost, send all cards again
+        state.sent_cards = {}
+
+    cards_message, state.sent_cards = card_delta(state.current_cards, state.sent_cards)
+    logger.debug(cards_message)
+    # the cards go last, so the system message is the same in every turn
+    history.append((cards_message, "cards"))
+
+    start = cut if cut is not None else state.summarized_upto
+    return ReplyJob(
+        system_message,
+        to_gemini_content(history[start:]),
+        state.current_cards,
+        state.cards_lock,
+        state.card_ids,
+        state.summary,
+        to_summarize,
+        cut,
     )
-    logger.debug(system_message.format(cards_string=cards_string))
-
-    try:
-        response: ModelAction = gemini_structured_ouput(
-            system_prompt=system_message.format(cards_string=cards_string),
-            contents=content,
-            Schema=ModelAction,
-            model_name="gemini-2.5-flash-preview-05-20",
-            disable_thinking=True,
-        )
-        if response is None:
-            raise RuntimeError("returnied invalid type")
 
-        for card in response.cards_to_add:
-            card.id = max(state.current_cards) + 1 if state.current_cards else 1
-            state.current_cards[card.id] = card
 
-        for card in response.cards_to_update:
-            if card.id not in state.current_cards:
-                logger.warning(f"{card.id} not in cards")
-                continue
-            logger.debug(f"upadatating {card.model_dump_json(indent=4)}")
-            state.current_cards[card.id] = card
-
-        for card_id in response.cards_to_delete:
-            state.current_cards.pop(card_id, None)
-        logger.debug(f"Got Response:\n{response.model_dump_json(indent=4)}")
-        return response.message_to_user
-    except Exception as e:
-        logger.exception(f"Model Answer failed {e}")
+def extract_from_uploads(uploads: list, instruction: Optional[str]) -> None:
+    """
+    Extracts cards from the uploads chunk by chunk, adding the new ones to the
+    current cards as every chunk finishes.
+    """
+    progress = st.progress(0.0, text="Preparing the uploads...")
+    chunks = document_chunks(uploads)
+    fronts = deck_fronts(state.current_cards.values())
+    n_added, n_duplicates, n_failed = 0, 0, 0
+    for n_done, result in enumerate(
+        iterate_sync(extract_cards_async(chunks, instruction)), 1
+    ):
+        new_cards = dedupe_cards(result.cards, fronts)
+        with state.cards_lock:
+            for card in new_cards:
+                card.id = next(state.card_ids)
+                state.current_cards[card.id] = card
+                fronts.append(card.a_content)
+        n_added += len(new_cards)
+        n_duplicates += len(result.cards) - len(new_cards)
+        n_failed += result.failed
+        progress.progress(
+            n_done / result.n_chunks,
+            text=f"Chunk {result.index + 1} of {result.n_chunks}: "
+            + ("failed" if result.failed else f"{len(new_cards)} new cards"),
+        )
 
-    return "Something wen't wrong. Try again."
+    reply = (
+        f"I extracted {n_added} cards from {len(chunks)} chunks"
+        f" and skipped {n_duplicates} duplicates."
+    )
+    if n_failed:
+        reply += f" {n_failed} chunks failed, extracting again retries them."
+    state.chat.append((reply, "bot"))
+
+
+@st.fragment(run_every=0.5 if state.reply_job else None)
+def render_reply_progress():
+    job: Optional[ReplyJob] = state.reply_job
+    if job is None:
+        return
+    if job.done:
+        state.reply_job = None
+        if job.summarized:
+            state.summary = job.summary
+            state.summarized_upto = job.summarize_upto
+        state.chat.append((job.reply, "bot"))
+        st.rerun()
+    st.markdown(
+        f'<div class="bot-msg">{markdown.markdown(job.message or "...")}</div>',
+        unsafe_allow_html=True,
+    )
 
 
 _, msg_area, _ = st.columns([1, 3, 1])
@@ -143,22 +311,30 @@ with msg_area:
         for file_name in state.images.difference(file_names):
             state.images.remove(file_name)
 
+            removed = [
+                i
+                for i, (a, b) in enumerate(state.chat)
+                if b == "image" and a.name == file_name
+            ]
+            state.summarized_upto -= sum(i < state.summarized_upto for i in removed)
             state.chat = [
                 (a, b) for a, b in state.chat if b != "image" or a.name != file_name
             ]
         assert file_names == state.images
 
     st.markdown("<br><br>", unsafe_allow_html=True)
+    thumbnail_cache.prefetch(msg for msg, sender in state.chat if sender == "image")
     for msg, sender in state.chat:
+        if sender == "cards":
+            continue
         if sender == "user":
             st.markdown(f'<div class="user-msg">{msg}</div>', unsafe_allow_html=True)
         elif sender == "image":
-            if not msg.name.endswith(".pdf"):
-                st.image(msg, width=200)
-                continue
-
-            for img in convert_from_bytes(msg.read()):
+            thumbnails = thumbnail_cache.get(msg)
+            for img in thumbnails.images:
                 st.image(img, width=200)
+            if thumbnails.n_pages > len(thumbnails.images):
+                st.caption(f"{thumbnails.n_pages - len(thumbnails.images)} more pages")
 
         else:
             st.markdown(
@@ -166,6 +342,8 @@ with msg_area:
                 unsafe_allow_html=True,
             )
 
+    render_reply_progress()
+
     col1, col2, col3 = st.columns([1, 5, 1])
     with col2:
         user_input = st.text_input(
@@ -173,13 +351,21 @@ with msg_area:
             key=f"input_{len(state.chat)}",
             label_visibility="collapsed",
         )
-        send_btn = st.button("Send")
+        send_btn = st.button("Send", disabled=state.reply_job is not None)
         if send_btn and user_input:
             state.chat.append((user_input, "user"))
+            state.reply_job = get_reply(state.chat)
+            st.rerun()
 
-            bot_reply = get_reply(state.chat)
-            if bot_reply:
-                state.chat.append((bot_reply, "bot"))
+        uploads = [msg for msg, sender in state.chat if sender == "image"]
+        extract_btn = st.button(
+            "Extract Cards from Uploads",
+            disabled=state.reply_job is not None or not uploads,
+            help="Creates cards from all uploads, a few pages at a time. "
+            "The message above, if any, is passed along as instruction.",
+        )
+        if extract_btn:
+            extract_from_uploads(uploads, user_input or None)
             st.rerun()
 
 
@@ -201,42 +387,57 @@ def render_card_box(card: SimpleAnkiCard, with_del=True):
         key=f"cat_{card.id}",
     )
     if cols[4].button("Save", key=f"save_{card.id}"):
-        state.current_cards[card.id] = card
+        with state.cards_lock:
+            state.current_cards[card.id] = card
+            if card.id == state.empty_card_id:
+                state.empty_card_id = next(state.card_ids)
         st.rerun()
     if with_del and cols[4].button("Delete", key=f"del_{card.id}"):
-        state.current_cards.pop(card.id)
+        with state.cards_lock:
+            # the model may have deleted it in the meantime
+            state.current_cards.pop(card.id, None)
         st.rerun()
 
 
+@st.fragment(run_every=0.5 if state.reply_job else None)
+def render_cards():
+    # a copy, a running reply job adds cards concurrently
+    with state.cards_lock:
+        cards = dict(state.current_cards)
+    for card in cards.values():
+        render_card_box(card)
+
+    # empy card
+    additional_card = SimpleAnkiCard(
+        id=state.empty_card_id,
+        a_content="",
+        b_content="",
+        category=CardCategory.adjective,
+    )
+    render_card_box(additional_card, with_del=False)
+
+
 st.markdown("<br><br>", unsafe_allow_html=True)
-for _, card in state.current_cards.items():
-    render_card_box(card)
-
-# empy card
-additional_card = SimpleAnkiCard(
-    id=max(state.current_cards) + 1 if state.current_cards else 1,
-    a_content="",
-    b_content="",
-    category=CardCategory.adjective,
-)
-render_card_box(additional_card, with_del=False)
+render_cards()
 
 
 st.markdown("<br><br>", unsafe_allow_html=True)
 _, middle, _ = st.columns([2, 1, 2])
 
 with middle:
-    button = st.button("Save Cards")
+    # saving replaces the cards a running reply job adds to
+    button = st.button("Save Cards", disabled=state.reply_job is not None)
 
     if button:
-        for _, card in tqdm(state.current_cards.items()):
-            card: SimpleAnkiCard
-            add_card(
-                a_content=card.a_content,
-                b_content=card.b_content,
-                notes=card.notes,
-                category=card.category,
-            )
+        with state.cards_lock:
+            cards = [
+                AnkiCard(**card.model_dump(exclude={"id"}))
+                for card in state.current_cards.values()
+            ]
+        add_audios_batch(cards)
+        add_cards(cards)
+
+        with state.cards_lock:
+            state.current_cards.clear()
 
-        state.current_cards = {}
         st.rerun()
@@ -92,6 +92,7 @@ if st.button("Submit"):
             """,
             user_input=user_input,
             Schema=FeedBackMessage,
+            call_site="sentence_practice",
         )
         if val is None:
             st.error("Sorry, I couldn't evaluate your sentence. Please try again.")
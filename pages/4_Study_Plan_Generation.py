@@ -1,12 +1,18 @@
 import markdown
 import streamlit as st
 from loguru import logger
-from pdf2image import convert_from_bytes
 from streamlit import session_state as state
 
 from src.plans.generate_and_save import generate_and_save
-from src.plans.planning import ChatSpeaker, History_Type, StudyPlan, generate_new_plan
+from src.plans.planning import (
+    ChatSpeaker,
+    History_Type,
+    PlanDraft,
+    StudyPlan,
+    generate_new_plan,
+)
 from src.plans.summarize import create_summaries_of_last_plans
+from src.thumbnails import thumbnail_cache
 
 st.markdown(
     f"""
@@ -78,16 +84,16 @@ def render_chat_messages(history: History_Type, from_idx: int = 0):
             unsafe_allow_html=True,
         )
 
+    thumbnail_cache.prefetch(
+        msg for sender, msg in history[from_idx:] if sender == ChatSpeaker.user_media
+    )
     for sender, msg in history[from_idx:]:  # fix: should be from from_idx onward
         if sender == ChatSpeaker.user_media:
-            if not msg.name.endswith(".pdf"):
-                st.image(msg, width=200)
-                continue
-
-            msg.seek(0)  # fix: reset file pointer for PDF
-            for img in convert_from_bytes(msg.read()):
+            thumbnails = thumbnail_cache.get(msg)
+            for img in thumbnails.images:
                 st.image(img, width=200)
-            msg.seek(0)  # reset again for future use
+            if thumbnails.n_pages > len(thumbnails.images):
+                st.caption(f"{thumbnails.n_pages - len(thumbnails.images)} more pages")
             continue
 
         msg = msg.user_message if sender == ChatSpeaker.planning_agent else msg
@@ -97,6 +103,19 @@ def render_chat_messages(history: History_Type, from_idx: int = 0):
         )
 
 
+def render_draft(draft: PlanDraft, area) -> None:
+    with area.container():
+        st.markdown(
+            f'<div class="bot-msg">{markdown.markdown(draft.user_message)}</div>',
+            unsafe_allow_html=True,
+        )
+        for i, task in enumerate(draft.tasks, 1):
+            st.markdown(
+                f"**Task {i}: {task.title}** "
+                f"({task.category.value.replace('_', ' ').title()})"
+            )
+
+
 with msg_area:
     uploaded_files = st.file_uploader(
         "Upload a file", type=["png", "jpg", "pdf"], accept_multiple_files=True
@@ -122,10 +141,22 @@ with msg_area:
                 if summary:
                     state.chat.append((ChatSpeaker.summary_agent, summary))
 
+            # every streamed plan gets its own area, below the messages so far
+            draft_area = None
+
+            def on_draft(draft: PlanDraft) -> None:
+                global draft_area
+                if draft_area is None:
+                    draft_area = st.empty()
+                render_draft(draft, draft_area)
+
             # fix: generate_new_plan expects history, not an int
             for new_hist, new_plan in generate_new_plan(
-                history=state.chat,
+                history=state.chat, on_draft=on_draft
             ):
+                if draft_area is not None:
+                    draft_area.empty()
+                    draft_area = None
                 if new_plan:
                     state.plan = new_plan
 
@@ -0,0 +1,71 @@
+from datetime import datetime, timedelta
+
+import streamlit as st
+
+import src.tasks  # noqa: F401  (registers the models the ORM needs to query)
+from src.llm import check_llm_health, usage_writer
+from src.llm_budget import RollupPeriod, get_rollups, token_budget
+from src.llm_cache import cache_stats
+from src.llm_telemetry import latency_report
+
+st.title("LLM Telemetry")
+
+st.subheader("Backends")
+# a ping per backend, so only on request
+if st.button("Check backends"):
+    for name, error in check_llm_health().items():
+        if error:
+            st.error(f"{name}: {error}")
+        else:
+            st.success(f"{name}: reachable")
+
+window = st.selectbox("Window", ["Last hour", "Last day", "Last week", "Last month"])
+since = {
+    "Last hour": datetime.now() - timedelta(hours=1),
+    "Last day": datetime.now() - timedelta(days=1),
+    "Last week": datetime.now() - timedelta(weeks=1),
+    "Last month": datetime.now() - timedelta(days=30),
+}[window]
+
+# make calls of this process that are still buffered visible
+usage_writer.flush()
+
+for group_by, header in (("call_site", "Per call site"), ("model_name", "Per model")):
+    st.subheader(header)
+    report = latency_report(since, group_by=group_by)
+    if not report:
+        st.info("No LLM calls recorded yet.")
+        continue
+    for row in report:
+        row["failure_rate"] *= 100
+    st.dataframe(
+        report,
+        column_config={
+            "failure_rate": st.column_config.NumberColumn(
+                "failure rate", format="%.1f %%"
+            ),
+            "p50_ms": st.column_config.NumberColumn(format="%.0f"),
+            "p95_ms": st.column_config.NumberColumn(format="%.0f"),
+            "p99_ms": st.column_config.NumberColumn(format="%.0f"),
+        },
+    )
+
+st.subheader("Tokens per day")
+rollups = get_rollups(RollupPeriod.day, since=since)
+if rollups:
+    st.dataframe(
+        [
+            rollup.model_dump(include={"bucket_start", "model_name", "calls"})
+            | {"tokens": rollup.input_tokens + rollup.output_tokens}
+            for rollup in rollups
+        ]
+    )
+if token_budget.enabled:
+    st.caption(
+        f"Used today: {token_budget.used()} tokens, "
+        f"daily budget: {token_budget.daily_budget or 'unlimited'}, "
+        f"per model: {token_budget.model_budgets}"
+    )
+
+st.subheader("Response cache of this process")
+st.json(cache_stats())
@@ -3,7 +3,14 @@ from enum import StrEnum
 from typing import TYPE_CHECKING, Optional
 
 from pydantic import BaseModel
-from sqlmodel import Column, Enum, Field, LargeBinary, Relationship, SQLModel
+from sqlmodel import (
+    Column,
+    Enum,
+    Field,
+    Index,
+    Relationship,
+    SQLModel,
+)
 
 if TYPE_CHECKING:
     from src.tasks.vocab_tasks import VocabTask
@@ -32,7 +39,11 @@ class CardCategory(StrEnum):
 
 
 class AnkiCard(SQLModel, table=True):
-    __table_args__ = {"extend_existing": True}
+    __table_args__ = (
+        # serves the due queue: filter by category and date, order by easiness
+        Index("ix_ankicard_due_queue", "category", "next_date", "easiness_factor"),
+        {"extend_existing": True},
+    )
     id: Optional[int] = Field(None, primary_key=True, index=True)
     vocab_task_id: Optional[int] = Field(default=None, foreign_key="vocabtask.id")
     vocab_task: Optional["VocabTask"] = Relationship(back_populates="cards")
@@ -54,11 +65,11 @@ class AnkiCard(SQLModel, table=True):
     )
 
     next_date: date = Field(default_factory=date.today, index=True)
-    a_mp3: Optional[bytes] = Field(
-        default=None, sa_column=Column(LargeBinary), description="Audio for a_content"
+    a_audio_key: Optional[str] = Field(
+        default=None, description="Key of the shared AudioClip for a_content"
     )
-    b_mp3: Optional[bytes] = Field(
-        default=None, sa_column=Column(LargeBinary), description="Audio for b_content"
+    b_audio_key: Optional[str] = Field(
+        default=None, description="Key of the shared AudioClip for b_content"
     )
     category: CardCategory = Field(
         sa_column=Column(Enum(CardCategory), index=True, nullable=False)
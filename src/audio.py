@@ -1,20 +1,327 @@
-import io
+import hashlib
+import mmap
+import os
+import threading
+import time
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from typing import Literal, Optional
 
-from gtts import gTTS
 from loguru import logger
+from sqlalchemy import inspect, text
+from sqlmodel import Field, Session, SQLModel, select
 
 from src.anki import AnkiCard
+from src.audio_processing import process_clip, transcode_file
+from src.db import engine
+from src.tts import TTSBackend, get_backend
 
+AUDIO_STORE_DIR = Path(os.environ.get("AUDIO_STORE_DIR", "audio_store"))
+# processed clips are stored as opus, raw backend output as mp3
+CLIP_EXTENSIONS = ("opus", "mp3")
 
-def _single_try(word: str, lang: str) -> io.BytesIO | None:
+
+class AudioClip(SQLModel, table=True):
+    """
+    A synthesized clip, shared by every card side with the same text, language and voice.
+    The audio itself lives in the audio store on disk, see `clip_path`.
+    """
+
+    __table_args__ = {"extend_existing": True}
+
+    key: str = Field(primary_key=True, description="sha256 of (voice, lang, text)")
+    text: str
+    lang: str
+    voice: str
+    size: Optional[int] = Field(None, description="Size of the clip in bytes")
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def clip_key(text: str, lang: str, voice: str = "gtts") -> str:
+    payload = f"{voice}\0{lang}\0{normalize_text(text)}"
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def clip_path(key: str, ext: str = "mp3") -> Path:
+    # sharded by the first two bytes of the key to keep directories small
+    return AUDIO_STORE_DIR / key[:2] / key[2:4] / f"{key}.{ext}"
+
+
+def find_clip(key: str) -> Optional[Path]:
+    for ext in CLIP_EXTENSIONS:
+        path = clip_path(key, ext)
+        if path.exists():
+            return path
+    return None
+
+
+def _write_clip(key: str, data: bytes, ext: str = "mp3") -> None:
+    path = clip_path(key, ext)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+
+
+def get_clip(key: Optional[str]) -> Optional[bytes]:
+    """
+    Reads a clip through a read-only memory map, so the file is copied once,
+    from the page cache straight into the bytes handed to `st.audio`.
+    """
+    path = find_clip(key) if key is not None else None
+    if path is None:
+        return None
+    try:
+        with (
+            open(path, "rb") as f,
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm,
+        ):
+            return mm[:]
+    except (FileNotFoundError, ValueError):
+        # ValueError: empty files cannot be mapped
+        return None
+
+
+def _single_try(
+    word: str, lang: str, backend: TTSBackend, timeout: Optional[float] = None
+) -> bytes | None:
     try:
-        mp3_bytes = io.BytesIO()
-        gTTS(word, lang=lang).write_to_fp(mp3_bytes)
-        return mp3_bytes.getvalue()
+        return backend.synthesize(word, lang, timeout=timeout)
     except Exception as e:
         logger.exception(f"Failed to generate audio - {e}")
 
 
+def _process_or_raw(data: bytes) -> tuple[bytes, str]:
+    """
+    Processed opus clip and its extension, or the raw mp3 if processing fails,
+    e.g. because ffmpeg is not installed.
+    """
+    try:
+        return process_clip(data), "opus"
+    except Exception as e:
+        logger.warning(f"Storing unprocessed clip, processing failed - {e}")
+        return data, "mp3"
+
+
+class RateLimiter:
+    """Spaces calls at least 1 / max_per_second apart, across threads. None means no limit."""
+
+    def __init__(self, max_per_second: Optional[float]):
+        self._interval = 1 / max_per_second if max_per_second else 0.0
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self._interval
+        time.sleep(slot - now)
+
+
+def synthesize_batch(
+    jobs: list[tuple[AnkiCard, Literal["a", "b"]]],
+    a_lang="es",
+    b_lang="de",
+    backend: Optional[TTSBackend] = None,
+    max_workers: Optional[int] = None,
+    timeout: float = 10,
+    max_per_second: Optional[float] = None,
+) -> list[Optional[str]]:
+    """
+    Sets the audio key of every (card, side) job. Clips that are not stored yet are
+    synthesized once per key on a bounded thread pool, with each request limited
+    by `timeout` seconds and all requests by `max_per_second`.
+    Pool size and rate default to the limits of the backend. New clips go
+    through `process_clip` before they are stored.
+    Returns the keys in the order of `jobs`, None where synthesis failed.
+    """
+    backend = backend or get_backend()
+    texts = [
+        (card.a_content, a_lang) if side == "a" else (card.b_content, b_lang)
+        for card, side in jobs
+    ]
+    keys = [clip_key(text, lang, voice=backend.name) for text, lang in texts]
+
+    with Session(engine) as sess:
+        stored = {
+            key
+            for key in sess.exec(
+                select(AudioClip.key).where(AudioClip.key.in_(set(keys)))
+            ).all()
+            if find_clip(key) is not None
+        }
+    missing = {key: text for key, text in zip(keys, texts) if key not in stored}
+
+    limiter = RateLimiter(max_per_second or backend.max_per_second)
+
+    def synthesize(text: str, lang: str) -> tuple[bytes, str] | None:
+        limiter.wait()
+        data = _single_try(text, lang, backend, timeout=timeout)
+        return _process_or_raw(data) if data is not None else None
+
+    with ThreadPoolExecutor(max_workers=max_workers or backend.max_workers) as pool:
+        futures = {
+            key: pool.submit(synthesize, text, lang)
+            for key, (text, lang) in missing.items()
+        }
+        clips = {key: future.result() for key, future in futures.items()}
+
+    with Session(engine) as sess:
+        for key, clip in clips.items():
+            if clip is None:
+                continue
+            data, ext = clip
+            clip_text, lang = missing[key]
+            _write_clip(key, data, ext)
+            # merge, so a clip stored concurrently for the same key is not an error
+            sess.merge(
+                AudioClip(
+                    key=key,
+                    text=normalize_text(clip_text),
+                    lang=lang,
+                    voice=backend.name,
+                    size=len(data),
+                )
+            )
+        sess.commit()
+
+    results = []
+    for (card, side), key in zip(jobs, keys):
+        key = key if key in stored or clips.get(key) is not None else None
+        setattr(card, f"{side}_audio_key", key)
+        results.append(key)
+    return results
+
+
+def add_audios_batch(cards: list[AnkiCard], **kwargs) -> None:
+    synthesize_batch([(card, side) for card in cards for side in ("a", "b")], **kwargs)
+
+
 def add_audios_inplance(card: AnkiCard, a_lang="es", b_lang="de"):
-    card.a_mp3 = _single_try(card.a_content, a_lang)
-    card.b_mp3 = _single_try(card.b_content, b_lang)
+    synthesize_batch([(card, "a"), (card, "b")], a_lang=a_lang, b_lang=b_lang)
+
+
+def load_card_audio(card: AnkiCard) -> tuple[Optional[bytes], Optional[bytes]]:
+    return get_clip(card.a_audio_key), get_clip(card.b_audio_key)
+
+
+def migrate_audio_to_store(a_lang="es", b_lang="de") -> None:
+    """
+    Moves the audio blobs out of the database into the audio store: the data of
+    AudioClip rows and the a_mp3/b_mp3 columns of cards created before the clip
+    store. The emptied columns are dropped and the database is vacuumed.
+    Does nothing once the columns are gone.
+    """
+    inspector = inspect(engine)
+    clip_columns = {col["name"] for col in inspector.get_columns("audioclip")}
+    card_columns = {col["name"] for col in inspector.get_columns("ankicard")}
+    if "data" not in clip_columns and not {"a_mp3", "b_mp3"} & card_columns:
+        return
+
+    with engine.begin() as conn:
+        if "data" in clip_columns:
+            keys = conn.execute(text("SELECT key FROM audioclip")).scalars().all()
+            for key in keys:
+                data = conn.execute(
+                    text("SELECT data FROM audioclip WHERE key = :key"), {"key": key}
+                ).scalar_one()
+                _write_clip(key, data)
+                conn.execute(
+                    text("UPDATE audioclip SET size = :size WHERE key = :key"),
+                    {"size": len(data), "key": key},
+                )
+            conn.execute(text("ALTER TABLE audioclip DROP COLUMN data"))
+            logger.info(f"Moved {len(keys)} audio clips to {AUDIO_STORE_DIR}")
+
+        for side, lang in (("a", a_lang), ("b", b_lang)):
+            column = f"{side}_mp3"
+            if column not in card_columns:
+                continue
+            card_ids = (
+                conn.execute(
+                    text(
+                        f"SELECT id FROM ankicard WHERE {column} IS NOT NULL"
+                        f" AND {side}_audio_key IS NULL"
+                    )
+                )
+                .scalars()
+                .all()
+            )
+            for card_id in card_ids:
+                content, data = conn.execute(
+                    text(
+                        f"SELECT {side}_content, {column} FROM ankicard WHERE id = :id"
+                    ),
+                    {"id": card_id},
+                ).one()
+                # legacy blobs were synthesized with gTTS, reuse an existing clip if any
+                key = clip_key(content, lang)
+                if find_clip(key) is None:
+                    _write_clip(key, data)
+                    conn.execute(
+                        text(
+                            "INSERT OR IGNORE INTO audioclip (key, text, lang, voice, size)"
+                            " VALUES (:key, :text, :lang, 'gtts', :size)"
+                        ),
+                        {
+                            "key": key,
+                            "text": normalize_text(content),
+                            "lang": lang,
+                            "size": len(data),
+                        },
+                    )
+                conn.execute(
+                    text(f"UPDATE ankicard SET {side}_audio_key = :key WHERE id = :id"),
+                    {"key": key, "id": card_id},
+                )
+            conn.execute(text(f"ALTER TABLE ankicard DROP COLUMN {column}"))
+            logger.info(f"Moved {len(card_ids)} {column} blobs to {AUDIO_STORE_DIR}")
+
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("VACUUM"))
+
+
+def transcode_store(max_workers: Optional[int] = None) -> tuple[int, int]:
+    """
+    Runs `process_clip` over every unprocessed (mp3) clip in the audio store on a
+    process pool, replacing it with the opus version.
+    Returns the total size of the transcoded clips before and after, in bytes.
+    """
+    with Session(engine) as sess:
+        keys = sess.exec(select(AudioClip.key)).all()
+    sources = {key: clip_path(key) for key in keys if clip_path(key).exists()}
+
+    size_before, size_after = 0, 0
+    n_transcoded, n_failed = 0, 0
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            key: pool.submit(transcode_file, path, clip_path(key, "opus"))
+            for key, path in sources.items()
+        }
+        with Session(engine) as sess:
+            for key, future in futures.items():
+                try:
+                    before, after = future.result()
+                except Exception as e:
+                    logger.error(f"Transcoding clip {key} failed - {e}")
+                    n_failed += 1
+                    continue
+                sources[key].unlink()
+                clip = sess.get(AudioClip, key)
+                clip.size = after
+                sess.add(clip)
+                size_before += before
+                size_after += after
+                n_transcoded += 1
+            sess.commit()
+
+    logger.info(
+        f"Transcoded {n_transcoded} clips, {n_failed} failed:"
+        f" {size_before / 1024:.1f} KiB -> {size_after / 1024:.1f} KiB"
+    )
+    return size_before, size_after
@@ -0,0 +1,50 @@
+import io
+from pathlib import Path
+
+from pydub import AudioSegment
+from pydub.silence import detect_leading_silence
+
+SILENCE_THRESHOLD_DBFS = -45.0
+TARGET_DBFS = -20.0
+OPUS_BITRATE = "24k"
+
+
+def clip_mimetype(data: bytes) -> str:
+    return "audio/ogg" if data[:4] == b"OggS" else "audio/mp3"
+
+
+def process_clip(data: bytes) -> bytes:
+    """
+    Trims leading and trailing silence, normalizes the loudness to TARGET_DBFS
+    and encodes the clip as mono Ogg Opus. Needs ffmpeg.
+    """
+    segment = AudioSegment.from_file(io.BytesIO(data))
+
+    start = detect_leading_silence(segment, silence_threshold=SILENCE_THRESHOLD_DBFS)
+    end = len(segment) - detect_leading_silence(
+        segment.reverse(), silence_threshold=SILENCE_THRESHOLD_DBFS
+    )
+    if start < end:
+        segment = segment[start:end]
+
+    if segment.dBFS != float("-inf"):
+        segment = segment.apply_gain(TARGET_DBFS - segment.dBFS)
+
+    opus_bytes = io.BytesIO()
+    segment.set_channels(1).export(
+        opus_bytes, format="opus", codec="libopus", bitrate=OPUS_BITRATE
+    )
+    return opus_bytes.getvalue()
+
+
+def transcode_file(src: Path, dst: Path) -> tuple[int, int]:
+    """
+    Process pool worker: writes the processed `src` clip to `dst`.
+    Returns the sizes before and after.
+    """
+    data = src.read_bytes()
+    processed = process_clip(data)
+    tmp_path = dst.with_suffix(".tmp")
+    tmp_path.write_bytes(processed)
+    tmp_path.replace(dst)
+    return len(data), len(processed)
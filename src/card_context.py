@@ -0,0 +1,90 @@
+import json
+from typing import Optional
+
+from google.genai import types
+
+from src.anki import SimpleAnkiCard
+from src.llm import gemini_text_response
+
+# Once the chat sent to the model is longer than this, the older messages are
+# summarized and only the last CARD_CHAT_KEEP_MESSAGES are sent in full.
+CARD_CHAT_MAX_MESSAGES = 16
+CARD_CHAT_KEEP_MESSAGES = 6
+
+SUMMARY_PROMPT = """You summarize the earlier part of a chat in which a user creates
+Anki cards with an assistant. Keep everything needed to continue the chat: the
+user's requests and preferences, open questions, and which content of the
+uploaded texts and images has not been turned into cards yet. Do not list the
+cards themselves, the assistant gets them separately. Be concise.
+"""
+
+
+def compact_card(card: SimpleAnkiCard) -> str:
+    return json.dumps(
+        card.model_dump(mode="json", exclude_none=True),
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+
+
+def id_index(ids) -> str:
+    """Sorted ids as ranges, e.g. "1-4,7"."""
+    ranges: list[list[int]] = []
+    for card_id in sorted(ids):
+        if ranges and ranges[-1][1] == card_id - 1:
+            ranges[-1][1] = card_id
+        else:
+            ranges.append([card_id, card_id])
+    return ",".join(
+        str(start) if start == end else f"{start}-{end}" for start, end in ranges
+    )
+
+
+def card_delta(
+    cards: dict[int, SimpleAnkiCard], sent: dict[int, str]
+) -> tuple[str, dict[int, str]]:
+    """
+    Describes the cards that were added, changed or deleted since `sent`, the
+    compact cards the model got so far, followed by the ids of all cards.
+    Returns the message and the new `sent`.
+    """
+    current = {card_id: compact_card(card) for card_id, card in cards.items()}
+    changed = [line for card_id, line in current.items() if sent.get(card_id) != line]
+    deleted = sorted(set(sent) - set(current))
+
+    lines = []
+    if changed:
+        lines.append("Cards added or changed since your last reply:")
+        lines.extend(changed)
+    if deleted:
+        lines.append(f"Deleted cards: {id_index(deleted)}")
+    if not lines:
+        lines.append("No cards changed since your last reply.")
+    lines.append(f"Ids of all current cards: {id_index(current) or 'none'}")
+    return "\n".join(lines), current
+
+
+def summary_cut(n_messages: int, summarized_upto: int) -> Optional[int]:
+    """Index up to which the chat should be summarized now, if it is too long."""
+    if n_messages - summarized_upto <= CARD_CHAT_MAX_MESSAGES:
+        return None
+    return n_messages - CARD_CHAT_KEEP_MESSAGES
+
+
+def summary_content(summary: str) -> types.Content:
+    return types.Content(
+        role="user",
+        parts=[types.Part(text=f"Summary of the earlier conversation:\n{summary}")],
+    )
+
+
+def summarize_chat(previous_summary: Optional[str], contents: list) -> Optional[str]:
+    """Folds `contents` into `previous_summary`. Returns None if it failed."""
+    if previous_summary:
+        contents = [summary_content(previous_summary), *contents]
+    return gemini_text_response(
+        SUMMARY_PROMPT,
+        contents,
+        timeout=30,
+        call_site="card_chat_summary",
+    )
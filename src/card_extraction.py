@@ -0,0 +1,142 @@
+import asyncio
+import hashlib
+import re
+import unicodedata
+from typing import AsyncGenerator, Iterable, NamedTuple, Optional
+
+from google.genai import types
+from loguru import logger
+
+from src.anki import SimpleAnkiCard
+from src.config import LEVEL, SOURCE_LANGUAGE, TARGET_LANGUAGE
+from src.db import get_card_fronts
+from src.llm import gemini_structured_ouput_async
+from src.media import media_registry, mime_type_of
+from src.media_processing import split_pdf
+
+# Pages per request, and requests sent at the same time. A chunk takes about
+# the same time, so a document takes ceil(pages / CHUNK_PAGES / MAX_PARALLEL_CHUNKS)
+# rounds of CHUNK_TIMEOUT at most.
+CHUNK_PAGES = 4
+MAX_PARALLEL_CHUNKS = 4
+CHUNK_TIMEOUT = 90
+
+EXTRACTION_PROMPT = f"""You create Anki cards from a part of a document, e.g. a few
+pages of a textbook chapter, for a {LEVEL} learner of {TARGET_LANGUAGE}.
+Front (a_content) in {TARGET_LANGUAGE}, back (b_content) in {SOURCE_LANGUAGE}.
+Create one card per vocabulary item, phrase or grammar example worth learning.
+Do not create cards for page numbers, exercise instructions or headings.
+Leave the id of every card empty.
+"""
+
+
+class ChunkResult(NamedTuple):
+    index: int
+    n_chunks: int
+    cards: list[SimpleAnkiCard]
+    failed: bool
+
+
+def _split(file, chunk_pages: int) -> list[bytes]:
+    try:
+        return split_pdf(file.getvalue(), chunk_pages)
+    except Exception as e:
+        logger.warning(f"Splitting {file.name} failed, sending it whole - {e!r}")
+        return [file.getvalue()]
+
+
+def document_chunks(files: Iterable, chunk_pages: int = CHUNK_PAGES) -> list[list]:
+    """
+    Parts of `files` grouped into chunks of `chunk_pages` pages: every PDF is
+    split into page ranges of that many pages, images are grouped.
+    """
+    pdfs, images = [], []
+    for file in files:
+        if mime_type_of(file.name) == "application/pdf":
+            pdfs.extend(
+                (piece, hashlib.sha256(piece).hexdigest())
+                for piece in _split(file, chunk_pages)
+            )
+        else:
+            images.append(file)
+
+    # prepared in parallel on the media process pool
+    for piece, digest in pdfs:
+        media_registry.prefetch(piece, "application/pdf", digest)
+    media_registry.prefetch_uploads(images)
+
+    chunks = [
+        media_registry.parts(piece, "application/pdf", digest) for piece, digest in pdfs
+    ]
+    image_parts = [
+        part for file in images for part in media_registry.upload_parts(file)
+    ]
+    chunks.extend(
+        image_parts[i : i + chunk_pages]
+        for i in range(0, len(image_parts), chunk_pages)
+    )
+    return chunks
+
+
+async def extract_cards_async(
+    chunks: list[list],
+    instruction: Optional[str] = None,
+    max_parallel: int = MAX_PARALLEL_CHUNKS,
+) -> AsyncGenerator[ChunkResult, None]:
+    """
+    Extracts cards from every chunk, at most `max_parallel` at a time. Yields
+    the result of every chunk as soon as it is done.
+    """
+    semaphore = asyncio.Semaphore(max_parallel)
+
+    async def extract(index: int, chunk: list) -> ChunkResult:
+        contents = [*chunk]
+        if instruction:
+            contents.append(types.Part(text=f"The user asks: {instruction}"))
+        async with semaphore:
+            cards = await gemini_structured_ouput_async(
+                EXTRACTION_PROMPT,
+                contents,
+                list[SimpleAnkiCard],
+                timeout=CHUNK_TIMEOUT,
+                call_site="card_extraction",
+            )
+        if cards is None:
+            logger.warning(f"Extracting cards from chunk {index + 1} failed")
+        return ChunkResult(index, len(chunks), cards or [], cards is None)
+
+    tasks = [asyncio.create_task(extract(i, chunk)) for i, chunk in enumerate(chunks)]
+    try:
+        for done in asyncio.as_completed(tasks):
+            yield await done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def _normalize_front(text: str) -> str:
+    text = unicodedata.normalize("NFKC", text).casefold()
+    return " ".join(re.sub(r"[^\w\s]", " ", text).split())
+
+
+def dedupe_cards(
+    cards: Iterable[SimpleAnkiCard], existing_fronts: Iterable[str]
+) -> list[SimpleAnkiCard]:
+    """
+    Drops cards whose front, ignoring case, punctuation and spacing, is in
+    `existing_fronts` or on an earlier card.
+    """
+    seen = {_normalize_front(front) for front in existing_fronts}
+    unique = []
+    for card in cards:
+        front = _normalize_front(card.a_content)
+        if not front or front in seen:
+            continue
+        seen.add(front)
+        unique.append(card)
+    return unique
+
+
+def deck_fronts(current_cards: Iterable[SimpleAnkiCard]) -> list[str]:
+    """Fronts of the saved deck and of the cards that are not saved yet."""
+    return get_card_fronts() + [card.a_content for card in current_cards]
@@ -1,32 +1,100 @@
 from datetime import date
 
-from sqlmodel import Session, create_engine, select
+from sqlalchemy import func, inspect, text
+from sqlmodel import Session, SQLModel, create_engine, select
 
 from src.anki import AnkiCard, CardCategory
-from src.audio import add_audios_inplance
 
 engine = create_engine("sqlite:///db.sqlite")
 
 
-def get_cards_next_cards(category="All") -> list[AnkiCard]:
+def init_db() -> None:
+    """
+    Creates missing tables, and adds columns and indexes that were added to
+    existing models, since `create_all` only creates tables that do not exist yet.
+    """
+    SQLModel.metadata.create_all(engine)
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in SQLModel.metadata.sorted_tables:
+            existing = {col["name"] for col in inspector.get_columns(table.name)}
+            for col in table.columns:
+                if col.name not in existing:
+                    col_type = col.type.compile(dialect=engine.dialect)
+                    conn.execute(
+                        text(
+                            f"ALTER TABLE {table.name} ADD COLUMN {col.name} {col_type}"
+                        )
+                    )
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+
+def get_due_counts() -> dict[CardCategory, int]:
+    """
+    Number of due cards per category, counted in a single GROUP BY query.
+    """
+    with Session(engine) as sess:
+        statement = (
+            select(AnkiCard.category, func.count())
+            .where(AnkiCard.next_date <= date.today())
+            .group_by(AnkiCard.category)
+        )
+        return {category: count for category, count in sess.exec(statement).all()}
+
+
+def get_due_card_ids(category="All", limit: int = 10, offset: int = 0) -> list[int]:
+    """
+    Ids of the next due cards, hardest first, paged with LIMIT/OFFSET.
+    """
+    with Session(engine) as sess:
+        statement = select(AnkiCard.id).where(AnkiCard.next_date <= date.today())
+
+        if category != "All":
+            statement = statement.where(AnkiCard.category == category)
+        statement = (
+            statement.order_by(AnkiCard.easiness_factor, AnkiCard.id)
+            .limit(limit)
+            .offset(offset)
+        )
+
+        return list(sess.exec(statement).all())
+
+
+def get_cards(ids: list[int]) -> list[AnkiCard]:
+    """
+    Loads the cards with the given ids, keeping the order of `ids`.
+    """
+    if not ids:
+        return []
+
+    with Session(engine) as sess:
+        statement = select(AnkiCard).where(AnkiCard.id.in_(ids))
+        by_id = {card.id: card for card in sess.exec(statement).all()}
+
+    return [by_id[card_id] for card_id in ids if card_id in by_id]
+
+
+def get_cards_next_cards(category="All", limit: int | None = None) -> list[AnkiCard]:
     with Session(engine) as sess:
         statement = select(AnkiCard).where(AnkiCard.next_date <= date.today())
 
         if category != "All":
             statement = statement.where(AnkiCard.category == category)
         statement = statement.order_by(AnkiCard.easiness_factor)
+        if limit is not None:
+            statement = statement.limit(limit)
 
-    return list(sess.exec(statement).all())
+        return list(sess.exec(statement).all())
 
 
-def add_card(a_content: str, b_content: str, category: CardCategory, notes: str | None):
+def add_cards(cards: list[AnkiCard]) -> None:
     with Session(engine) as session:
-        obj = AnkiCard(
-            a_content=a_content,
-            b_content=b_content,
-            category=category,
-            notes=notes,
-        )
-        add_audios_inplance(obj)
-        session.add(obj)
+        session.add_all(cards)
         session.commit()
+
+
+def get_card_fronts() -> list[str]:
+    """The front (a_content) of every card in the deck."""
+    with Session(engine) as sess:
+        return list(sess.exec(select(AnkiCard.a_content)).all())
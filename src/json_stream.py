@@ -0,0 +1,137 @@
+import json
+import re
+from collections import defaultdict
+from typing import Any, Optional
+
+from loguru import logger
+
+# An escape cut off at the end of the text so far, after any escaped
+# backslashes. A \u escape of a high surrogate waits for its low surrogate.
+_INCOMPLETE_ESCAPE = re.compile(
+    r"(?<!\\)((?:\\\\)*)(?:\\u[dD][89abAB][0-9a-fA-F]{2})?(?:\\(?:u[0-9a-fA-F]{0,3})?)?$"
+)
+
+
+class JSONStreamParser:
+    """
+    Incremental parser for a JSON object that arrives in chunks, e.g. a streamed
+    structured LLM response. Every character is scanned once. It collects the
+    complete top-level fields, the complete items of top-level arrays, and gives
+    the partial text of a top-level string while it is being streamed.
+    """
+
+    def __init__(self) -> None:
+        self.text = ""
+        self.fields: dict[str, Any] = {}
+        self.items: dict[str, list[Any]] = defaultdict(list)
+        self._pos = 0
+        self._stack: list[str] = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._expect_key = False
+        self._key: Optional[str] = None
+        self._value_start: Optional[int] = None
+        self._item_start: Optional[int] = None
+
+    def feed(self, chunk: str) -> list[tuple[str, Any]]:
+        """
+        Scans `chunk`. Returns the items of top-level arrays it completed, as
+        (key of the array, item).
+        """
+        self.text += chunk
+        completed = []
+        for i in range(self._pos, len(self.text)):
+            c = self.text[i]
+            depth = len(self._stack)
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    if depth == 1 and self._expect_key:
+                        self._key = json.loads(self.text[self._string_start : i + 1])
+                continue
+            if c.isspace():
+                continue
+
+            if depth == 1 and not self._expect_key and self._value_start is None:
+                if c not in ",}":
+                    self._value_start = i
+            if self._in_top_level_array() and self._item_start is None:
+                if c not in ",]":
+                    self._item_start = i
+
+            if c == '"':
+                self._in_string = True
+                self._string_start = i
+            elif c in "{[":
+                self._stack.append(c)
+                if len(self._stack) == 1:
+                    self._expect_key = True
+            elif c in "}]":
+                self._end_scalar(i, completed)
+                self._stack.pop()
+                if self._in_top_level_array() and self._item_start is not None:
+                    self._add_item(self.text[self._item_start : i + 1], completed)
+                    self._item_start = None
+                if len(self._stack) == 1 and self._value_start is not None:
+                    self._add_field(self.text[self._value_start : i + 1])
+                    self._value_start = None
+            elif c == ",":
+                self._end_scalar(i, completed)
+                if depth == 1:
+                    self._expect_key = True
+            elif c == ":" and depth == 1:
+                self._expect_key = False
+
+        self._pos = len(self.text)
+        return completed
+
+    def partial_string(self, key: str) -> Optional[str]:
+        """The text of the top-level string field `key` so far, None if it has not started."""
+        if key in self.fields:
+            return self.fields[key]
+        streaming = (
+            self._in_string
+            and len(self._stack) == 1
+            and not self._expect_key
+            and self._key == key
+        )
+        if not streaming:
+            return None
+        raw = _INCOMPLETE_ESCAPE.sub(r"\1", self.text[self._string_start + 1 :])
+        try:
+            return json.loads(f'"{raw}"')
+        except json.JSONDecodeError:
+            return None
+
+    def _in_top_level_array(self) -> bool:
+        return len(self._stack) == 2 and self._stack[-1] == "["
+
+    def _end_scalar(self, end: int, completed: list[tuple[str, Any]]) -> None:
+        # numbers, strings, true, false and null end at the next , ] or }
+        if self._in_top_level_array() and self._item_start is not None:
+            self._add_item(self.text[self._item_start : end], completed)
+            self._item_start = None
+        elif len(self._stack) == 1 and self._value_start is not None:
+            self._add_field(self.text[self._value_start : end])
+            self._value_start = None
+
+    def _add_item(self, raw: str, completed: list[tuple[str, Any]]) -> None:
+        try:
+            item = json.loads(raw)
+        except json.JSONDecodeError:
+            logger.warning(f"Skipping unparsable item of {self._key}: {raw}")
+            return
+        self.items[self._key].append(item)
+        completed.append((self._key, item))
+
+    def _add_field(self, raw: str) -> None:
+        try:
+            self.fields[self._key] = json.loads(raw)
+        except json.JSONDecodeError:
+            logger.warning(f"Skipping unparsable field {self._key}: {raw}")
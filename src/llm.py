@@ -1,17 +1,48 @@
 import asyncio
+import atexit
+import concurrent.futures
+import contextvars
+import json
 import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Optional, Type
-
+from typing import (
+    Any,
+    AsyncGenerator,
+    AsyncIterator,
+    Callable,
+    Coroutine,
+    Iterator,
+    Optional,
+    Type,
+    TypeVar,
+)
+
+import httpx
+import ollama
 from dotenv import load_dotenv
 from google import genai
 from google.genai import types
 from loguru import logger
-from ollama import chat
-from pydantic import BaseModel, ValidationError
+from pydantic import BaseModel, TypeAdapter, ValidationError
 from sqlmodel import Field, SQLModel
 
 from src.db import Session, engine
+from src.llm_budget import BudgetExceededError, add_to_rollups, token_budget
+from src.llm_cache import (
+    CACHE_DISABLED,
+    cache_key,
+    count_event,
+    delete_cached,
+    get_cached,
+    put_cached,
+    try_lock_inflight,
+    unlock_inflight,
+)
+from src.llm_telemetry import CallOutcome, LLMCall, payload_size, retry_attempt
 
 
 class ModelUsage(SQLModel, table=True):
@@ -22,6 +53,8 @@ class ModelUsage(SQLModel, table=True):
     usage_time: datetime
     input_tokens: int
     output_tokens: int
+    # part of input_tokens served from a cached system prompt
+    cached_tokens: int = 0
 
     def __repr__(self):
         return f"On {self.usage_time.date()}: {self.model_name} used with input={self.input_tokens}, output={self.output_tokens}"
@@ -29,16 +62,23 @@ class ModelUsage(SQLModel, table=True):
 
 assert load_dotenv()
 
+T = TypeVar("T")
+
 
 def retry_n_times(n=3):
     """
     Decorator that retries the decorated function up to n times until it returns a non-None result.
+    The attempt number is recorded with every LLM call made by the function.
     """
 
     def decorator(fn):
         def wrapper(*args, **kwargs):
             for attempt in range(n):
-                result = fn(*args, **kwargs)
+                token = retry_attempt.set(attempt + 1)
+                try:
+                    result = fn(*args, **kwargs)
+                finally:
+                    retry_attempt.reset(token)
                 if result is not None:
                     return result
                 if attempt + 1 < n:
@@ -50,6 +90,80 @@ def retry_n_times(n=3):
     return decorator
 
 
+# ModelUsage and LLMCall rows are written in batches of this size, or after this many seconds.
+USAGE_FLUSH_SIZE = int(os.environ.get("USAGE_FLUSH_SIZE", 50))
+USAGE_FLUSH_INTERVAL = float(os.environ.get("USAGE_FLUSH_INTERVAL", 5))
+
+
+class UsageWriter:
+    """
+    Buffers usage rows (ModelUsage, LLMCall) in memory and writes them in one transaction from a
+    background thread, once `flush_size` rows are pending or `flush_interval`
+    seconds have passed. Pending rows are written at interpreter exit.
+    """
+
+    def __init__(self, flush_size: int, flush_interval: float):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._buffer: list[SQLModel] = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+
+    def add(self, row: SQLModel) -> None:
+        with self._lock:
+            self._buffer.append(row)
+            full = len(self._buffer) >= self.flush_size
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(
+                    target=self._run, name="usage-writer", daemon=True
+                )
+                self._thread.start()
+                atexit.register(self.close)
+        if self._closed:
+            self.flush()
+        elif full:
+            self._wake.set()
+
+    def flush(self) -> None:
+        with self._flush_lock:
+            with self._lock:
+                batch, self._buffer = self._buffer, []
+            if not batch:
+                return
+            usages = [row for row in batch if isinstance(row, ModelUsage)]
+            try:
+                # not expired, the budget reads the rows after the commit
+                with Session(engine, expire_on_commit=False) as sess:
+                    sess.add_all(batch)
+                    add_to_rollups(sess, usages)
+                    sess.commit()
+            except Exception as e:
+                logger.error(f"Writing {len(batch)} usage rows failed - {e}")
+                with self._lock:
+                    self._buffer[:0] = batch
+                return
+            token_budget.on_flushed(usages)
+
+    def _run(self) -> None:
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def close(self) -> None:
+        self._closed = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+
+usage_writer = UsageWriter(USAGE_FLUSH_SIZE, USAGE_FLUSH_INTERVAL)
+
+
 def save_model_usage(response, model_name):
     usage = ModelUsage(
         model_name=model_name,
@@ -59,82 +173,500 @@ def save_model_usage(response, model_name):
     )
     if response.usage_metadata.thoughts_token_count:
         usage.output_tokens += response.usage_metadata.thoughts_token_count
+    if response.usage_metadata.cached_content_token_count:
+        usage.cached_tokens = response.usage_metadata.cached_content_token_count
 
     logger.debug(usage.__repr__())
-    with Session(engine) as sess:
-        sess.add(usage)
-        sess.commit()
+    token_budget.record(model_name, usage.input_tokens + usage.output_tokens)
+    usage_writer.add(usage)
 
 
-def gemini_text_response(
-    system_prompt: str,
-    contents,
-    model_name: str = "gemini-2.0-flash",
-    disable_thinking: bool = False,
-    timeout: Optional[float] = None,
-):
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+
+
+def _event_loop() -> asyncio.AbstractEventLoop:
+    """
+    The event loop every sync wrapper runs on. It lives in a daemon thread for the
+    whole process, so it is shared by all Streamlit sessions and reruns.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_loop.run_forever, name="llm-event-loop", daemon=True
+            ).start()
+    return _loop
+
+
+def run_sync(coro: Coroutine[Any, Any, T]) -> T:
+    """
+    Runs `coro` on the shared event loop and blocks until it is done.
+    It sees the context variables of the caller, e.g. `retry_attempt`: the loop
+    runs it in a copy of the caller's context.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, _event_loop()).result()
+
+
+# Connection pool limits of the shared LLM clients, per client.
+LLM_MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", 20))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("LLM_MAX_KEEPALIVE_CONNECTIONS", 10))
+LLM_KEEPALIVE_EXPIRY = float(os.environ.get("LLM_KEEPALIVE_EXPIRY", 120))
+
+_clients: dict[str, Any] = {}
+_clients_lock = threading.Lock()
+
+
+def _pool_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+    )
+
+
+def _get_client(name: str, factory: Callable[[], T]) -> T:
+    with _clients_lock:
+        if name not in _clients:
+            _clients[name] = factory()
+        return _clients[name]
+
+
+def get_gemini_client() -> genai.Client:
+    """
+    The process-wide Gemini client. Its keep-alive connection pools are reused by
+    every call, Streamlit session and rerun. Async calls must run on `_event_loop`.
+    """
+
+    def create() -> genai.Client:
+        # explicit transports carry the pool limits (and keep genai on httpx)
+        return genai.Client(
+            api_key=os.environ["GEMINI_KEY"],
+            http_options=types.HttpOptions(
+                client_args={"transport": httpx.HTTPTransport(limits=_pool_limits())},
+                async_client_args={
+                    "transport": httpx.AsyncHTTPTransport(limits=_pool_limits())
+                },
+            ),
+        )
+
+    return _get_client("gemini", create)
+
+
+def get_ollama_client() -> ollama.Client:
+    """The process-wide Ollama client, see `get_gemini_client`."""
+    return _get_client("ollama", lambda: ollama.Client(limits=_pool_limits()))
+
+
+async def _check_gemini() -> None:
+    await get_gemini_client().aio.models.get(model="gemini-2.0-flash")
+
+
+def check_llm_health(timeout: float = 5) -> dict[str, Optional[str]]:
+    """
+    Pings every LLM backend through its shared client.
+    Returns None per healthy backend, otherwise the error message.
+    """
+    health: dict[str, Optional[str]] = {}
+    try:
+        run_sync(asyncio.wait_for(_check_gemini(), timeout=timeout))
+        health["gemini"] = None
+    except Exception as e:
+        health["gemini"] = repr(e)
+
+    try:
+        get_ollama_client().list()
+        health["ollama"] = None
+    except Exception as e:
+        health["ollama"] = repr(e)
+
+    for name, error in health.items():
+        if error:
+            logger.warning(f"{name} is unhealthy: {error}")
+    return health
+
+
+def _gemini_config(
+    system_prompt: str, disable_thinking: bool, Schema=None
+) -> types.GenerateContentConfig:
     config_args = {
         "system_instruction": system_prompt,
     }
+    if Schema is not None:
+        config_args["response_schema"] = Schema
+        config_args["response_mime_type"] = "application/json"
 
     if disable_thinking:
         config_args["thinking_config"] = types.ThinkingConfig(thinking_budget=0)
+    return types.GenerateContentConfig(**config_args)
+
+
+async def _generate_content(
+    model_name: str,
+    config: types.GenerateContentConfig,
+    contents,
+    timeout: Optional[float],
+) -> types.GenerateContentResponse:
+    # the request is awaited, so wait_for cancels it once the timeout is over
+    response = await asyncio.wait_for(
+        get_gemini_client().aio.models.generate_content(
+            model=model_name, config=config, contents=contents
+        ),
+        timeout=timeout,
+    )
+    save_model_usage(response, model_name)
+    return response
+
 
+def _outcome_of(e: BaseException) -> CallOutcome:
+    if isinstance(e, asyncio.TimeoutError):
+        return CallOutcome.timeout
+    if isinstance(e, BudgetExceededError):
+        return CallOutcome.over_budget
+    if isinstance(e, (GeneratorExit, asyncio.CancelledError)):
+        return CallOutcome.cancelled
+    if isinstance(e, (ValidationError, json.JSONDecodeError)):
+        return CallOutcome.validation_error
+    return CallOutcome.error
+
+
+def _new_call(model_name: str, call_site: str, system_prompt: str, contents) -> LLMCall:
+    return LLMCall(
+        model_name=model_name,
+        call_site=call_site,
+        started_at=datetime.now(),
+        attempt=retry_attempt.get(),
+        request_bytes=payload_size(system_prompt) + payload_size(contents),
+    )
+
+
+@contextmanager
+def _track_call(
+    model_name: str, call_site: str, system_prompt: str, contents
+) -> Iterator[LLMCall]:
+    """
+    Records the wall time and outcome of the LLM call in the block as an LLMCall.
+    The block sets `response_bytes`, and `outcome` if the call returned no result.
+    """
+    call = _new_call(model_name, call_site, system_prompt, contents)
+    start = time.perf_counter()
     try:
+        yield call
+    except BaseException as e:
+        call.outcome = _outcome_of(e)
+        raise
+    finally:
+        call.wall_time_ms = (time.perf_counter() - start) * 1000
+        usage_writer.add(call)
 
-        async def call_gemini():
-            client = genai.Client(api_key=os.environ["GEMINI_KEY"])
-            response = client.models.generate_content(
-                model=model_name,
-                config=types.GenerateContentConfig(**config_args),
-                contents=contents,
+
+def _parse_structured(Schema, text: str) -> Any:
+    if isinstance(Schema, dict):
+        return json.loads(text)
+    return TypeAdapter(Schema).validate_json(text)
+
+
+# Requests in flight in this process, shared by identical concurrent calls.
+_inflight: dict[str, concurrent.futures.Future] = {}
+_inflight_lock = threading.Lock()
+INFLIGHT_POLL_INTERVAL = 0.2
+
+
+async def _single_flight(
+    key: str, call_site: str, fetch: Callable[[], Coroutine[Any, Any, T]]
+) -> T:
+    """
+    Awaits `fetch` once per `key` at a time: concurrent callers with the same key,
+    from any thread or event loop, wait for the running call and share its result.
+    """
+    with _inflight_lock:
+        future = _inflight.get(key)
+        leader = future is None
+        if leader:
+            future = _inflight[key] = concurrent.futures.Future()
+
+    if not leader:
+        count_event("coalesced", call_site)
+        # shielded, so a cancelled follower does not cancel the shared call
+        return await asyncio.shield(asyncio.wrap_future(future))
+
+    try:
+        result = await fetch()
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+
+
+async def _fetch_once_across_processes(
+    key: str,
+    call_site: str,
+    timeout: Optional[float],
+    fetch: Callable[[], Coroutine[Any, Any, Optional[str]]],
+) -> Optional[str]:
+    """
+    Holds the lock file of `key` while awaiting `fetch`. While another process
+    holds it, waits for that process, at most `timeout` seconds, and takes its
+    result from the response cache.
+    """
+    deadline = time.monotonic() + timeout if timeout else None
+    waited = False
+    while (lock := try_lock_inflight(key)) is None:
+        if deadline is not None and time.monotonic() > deadline:
+            raise asyncio.TimeoutError(
+                f"Identical request of another process took over {timeout}s"
             )
-            save_model_usage(response, model_name)
-            return response
+        waited = True
+        await asyncio.sleep(INFLIGHT_POLL_INTERVAL)
+
+    try:
+        if waited:
+            # the result is in the cache, unless the other process failed
+            cached = await asyncio.to_thread(get_cached, key, call_site, False)
+            if cached is not None:
+                count_event("coalesced", call_site)
+                return cached
+        return await fetch()
+    finally:
+        unlock_inflight(key, lock)
+
+
+class BatchPending(BaseException):
+    """
+    Raised instead of sending a request while batch requests are collected, see
+    `collect_batch_requests`. A BaseException, so the `except Exception` of the
+    callers lets it through to the batch runner.
+    """
+
 
-        response = asyncio.run(asyncio.wait_for(call_gemini(), timeout=timeout))
+@dataclass
+class BatchRequest:
+    key: str
+    call_site: str
+    model_name: str
+    system_prompt: str
+    contents: Any
+    Schema: Any
+    disable_thinking: bool
 
+
+_batch_requests: contextvars.ContextVar[Optional[dict[str, BatchRequest]]] = (
+    contextvars.ContextVar("batch_requests", default=None)
+)
+
+
+@contextmanager
+def collect_batch_requests() -> Iterator[dict[str, BatchRequest]]:
+    """
+    In the block, cached requests that miss the cache are not sent but collected
+    in the yielded dict, by cache key, and raise BatchPending. Once the batch
+    results are in the cache, running the same code again gets them from there.
+    Raises ValueError if the response cache is disabled.
+    """
+    if CACHE_DISABLED:
+        raise ValueError(
+            "Batch mode needs the response cache, unset LLM_CACHE_DISABLED"
+        )
+    requests: dict[str, BatchRequest] = {}
+    token = _batch_requests.set(requests)
+    try:
+        yield requests
+    finally:
+        _batch_requests.reset(token)
+
+
+async def _lookup_cache(
+    key: str, model_name: str, call_site: str, system_prompt: str, contents
+) -> Optional[str]:
+    """The cached response of `key`, recorded as a cache hit LLMCall."""
+    start = time.perf_counter()
+    cached = await asyncio.to_thread(get_cached, key, call_site)
+    if cached is not None:
+        call = _new_call(model_name, call_site, system_prompt, contents)
+        call.outcome = CallOutcome.cache_hit
+        call.wall_time_ms = (time.perf_counter() - start) * 1000
+        call.response_bytes = payload_size(cached)
+        usage_writer.add(call)
+    return cached
+
+
+async def _cached_generate(
+    system_prompt: str,
+    contents,
+    Schema,
+    model_name: str,
+    disable_thinking: bool,
+    timeout: Optional[float],
+    call_site: str,
+    use_cache: bool,
+) -> Any:
+    """
+    The response text, or the parsed response if a `Schema` is given.
+    Answers from the response cache unless `use_cache` is False, or the call is
+    a retry (see `retry_n_times`); only valid responses are cached, with the TTL
+    of `call_site`. Identical concurrent requests are sent once, see
+    `_single_flight`; across processes only when the cache is used, as it
+    carries the result.
+    """
+    use_cache = use_cache and not CACHE_DISABLED
+    if _batch_requests.get() is not None and not use_cache:
+        # it would be sent right away, at the interactive price
+        raise ValueError(
+            f"{call_site} bypasses the response cache and cannot be batched"
+        )
+    key = cache_key(
+        model_name,
+        system_prompt,
+        contents,
+        Schema,
+        disable_thinking=disable_thinking,
+    )
+    if use_cache:
+        if retry_attempt.get() > 1:
+            # the caller retries because it rejected the earlier, maybe cached,
+            # response; the new one replaces it
+            await asyncio.to_thread(delete_cached, key)
+        else:
+            cached = await _lookup_cache(
+                key, model_name, call_site, system_prompt, contents
+            )
+            if cached is not None:
+                return cached if Schema is None else _parse_structured(Schema, cached)
+
+        batch = _batch_requests.get()
+        if batch is not None:
+            batch[key] = BatchRequest(
+                key,
+                call_site,
+                model_name,
+                system_prompt,
+                contents,
+                Schema,
+                disable_thinking,
+            )
+            raise BatchPending(key)
+
+    async def fetch() -> Optional[str]:
+        with _track_call(model_name, call_site, system_prompt, contents) as call:
+            # raises BudgetExceededError if neither the model nor a downgrade is in budget
+            call.model_name = await token_budget.resolve_model(model_name)
+            # the downgrades do not think, and reject a thinking config
+            downgraded = call.model_name != model_name
+            response = await _generate_content(
+                call.model_name,
+                _gemini_config(
+                    system_prompt, disable_thinking and not downgraded, Schema
+                ),
+                contents,
+                timeout,
+            )
+            call.response_bytes = payload_size(response.text)
+            if not response.text:
+                call.outcome = CallOutcome.empty
+                return None
+            if Schema is not None:
+                # raises on invalid output, which is then neither cached nor shared
+                _parse_structured(Schema, response.text)
+        # answers of a downgraded model are not cached for the requested one
+        if use_cache and not downgraded:
+            await asyncio.to_thread(
+                put_cached, key, call_site, model_name, response.text
+            )
         return response.text
+
+    if use_cache:
+        text = await _single_flight(
+            key,
+            call_site,
+            lambda: _fetch_once_across_processes(key, call_site, timeout, fetch),
+        )
+    else:
+        text = await _single_flight(key, call_site, fetch)
+
+    if text is None or Schema is None:
+        return text
+    return _parse_structured(Schema, text)
+
+
+async def gemini_text_response_async(
+    system_prompt: str,
+    contents,
+    model_name: str = "gemini-2.0-flash",
+    disable_thinking: bool = False,
+    timeout: Optional[float] = None,
+    call_site: str = "default",
+    use_cache: bool = True,
+) -> Optional[str]:
+    try:
+        return await _cached_generate(
+            system_prompt,
+            contents,
+            None,
+            model_name,
+            disable_thinking,
+            timeout,
+            call_site,
+            use_cache,
+        )
     except asyncio.TimeoutError:
-        logger.error("Gemini structured input timed out.")
+        logger.error("Gemini text response timed out.")
         return None
     except Exception as e:
         logger.error(f"Gemini failed with {e}")
         return None
 
 
-def gemini_structured_ouput(
+def gemini_text_response(
     system_prompt: str,
     contents,
-    Schema: Type[BaseModel],
     model_name: str = "gemini-2.0-flash",
     disable_thinking: bool = False,
     timeout: Optional[float] = None,
-) -> Optional[BaseModel]:
-    config_args = {
-        "system_instruction": system_prompt,
-        "response_schema": Schema,
-        "response_mime_type": "application/json",
-    }
-
-    if disable_thinking:
-        config_args["thinking_config"] = types.ThinkingConfig(thinking_budget=0)
-
-    async def call_gemini():
-        client = genai.Client(api_key=os.environ["GEMINI_KEY"])
-        response = client.models.generate_content(
-            model=model_name,
-            config=types.GenerateContentConfig(**config_args),
-            contents=contents,
+    call_site: str = "default",
+    use_cache: bool = True,
+) -> Optional[str]:
+    return run_sync(
+        gemini_text_response_async(
+            system_prompt,
+            contents,
+            model_name,
+            disable_thinking,
+            timeout,
+            call_site,
+            use_cache,
         )
-        save_model_usage(response, model_name)
-        return response
+    )
 
+
+async def gemini_structured_ouput_async(
+    system_prompt: str,
+    contents,
+    Schema: Type[BaseModel],
+    model_name: str = "gemini-2.0-flash",
+    disable_thinking: bool = False,
+    timeout: Optional[float] = None,
+    call_site: str = "default",
+    use_cache: bool = True,
+) -> Optional[BaseModel]:
     try:
-        response = asyncio.run(asyncio.wait_for(call_gemini(), timeout=timeout))
-        if not response.parsed:
+        parsed = await _cached_generate(
+            system_prompt,
+            contents,
+            Schema,
+            model_name,
+            disable_thinking,
+            timeout,
+            call_site,
+            use_cache,
+        )
+        if not parsed:
             raise RuntimeError("No response received from Gemini structured input.")
-        return response.parsed
+        return parsed
     except asyncio.TimeoutError:
         logger.error("Gemini structured input timed out.")
         return None
@@ -143,8 +675,157 @@ def gemini_structured_ouput(
         return None
 
 
+def gemini_structured_ouput(
+    system_prompt: str,
+    contents,
+    Schema: Type[BaseModel],
+    model_name: str = "gemini-2.0-flash",
+    disable_thinking: bool = False,
+    timeout: Optional[float] = None,
+    call_site: str = "default",
+    use_cache: bool = True,
+) -> Optional[BaseModel]:
+    return run_sync(
+        gemini_structured_ouput_async(
+            system_prompt,
+            contents,
+            Schema,
+            model_name,
+            disable_thinking,
+            timeout,
+            call_site,
+            use_cache,
+        )
+    )
+
+
+# Yields the text of a response in chunks, given model name, config and contents.
+StreamSource = Callable[
+    [str, types.GenerateContentConfig, Any], AsyncGenerator[str, None]
+]
+
+
+async def _gemini_stream(
+    model_name: str, config: types.GenerateContentConfig, contents
+) -> AsyncGenerator[str, None]:
+    stream = await get_gemini_client().aio.models.generate_content_stream(
+        model=model_name, config=config, contents=contents
+    )
+    last = None
+    async for chunk in stream:
+        last = chunk
+        if chunk.text:
+            yield chunk.text
+    # the last chunk carries the token counts of the whole response
+    if last is not None and last.usage_metadata:
+        save_model_usage(last, model_name)
+
+
+def local_stream(text: str, chunk_size: int = 16, delay: float = 0.05) -> StreamSource:
+    """
+    Stand-in for the Gemini streaming API that replays `text` in chunks,
+    for tests and offline development.
+    """
+
+    async def source(model_name, config, contents) -> AsyncGenerator[str, None]:
+        for start in range(0, len(text), chunk_size):
+            await asyncio.sleep(delay)
+            yield text[start : start + chunk_size]
+
+    return source
+
+
+async def gemini_stream_async(
+    system_prompt: str,
+    contents,
+    Schema=None,
+    model_name: str = "gemini-2.0-flash",
+    disable_thinking: bool = False,
+    timeout: Optional[float] = None,
+    call_site: str = "default",
+    use_cache: bool = True,
+    source: Optional[StreamSource] = None,
+) -> AsyncGenerator[str, None]:
+    """
+    Yields the response text in chunks as Gemini generates it (or `source`, see
+    `local_stream`). A cached response is yielded as one chunk. `timeout` bounds
+    the whole response. Raises like `_generate_content`; once complete, a
+    response that does not parse against `Schema` raises and is not cached.
+    """
+    use_cache = use_cache and not CACHE_DISABLED
+    key = cache_key(
+        model_name,
+        system_prompt,
+        contents,
+        Schema,
+        disable_thinking=disable_thinking,
+    )
+    if use_cache:
+        cached = await _lookup_cache(
+            key, model_name, call_site, system_prompt, contents
+        )
+        if cached is not None:
+            yield cached
+            return
+
+    with _track_call(model_name, call_site, system_prompt, contents) as call:
+        call.model_name = await token_budget.resolve_model(model_name)
+        downgraded = call.model_name != model_name
+        chunks = (source or _gemini_stream)(
+            call.model_name,
+            _gemini_config(system_prompt, disable_thinking and not downgraded, Schema),
+            contents,
+        )
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        text = ""
+        try:
+            while True:
+                remaining = (
+                    max(deadline - time.monotonic(), 0)
+                    if deadline is not None
+                    else None
+                )
+                try:
+                    chunk = await asyncio.wait_for(anext(chunks), timeout=remaining)
+                except StopAsyncIteration:
+                    break
+                text += chunk
+                yield chunk
+        finally:
+            await chunks.aclose()
+
+        call.response_bytes = payload_size(text)
+        if not text:
+            call.outcome = CallOutcome.empty
+            return
+        if Schema is not None:
+            _parse_structured(Schema, text)
+
+    if use_cache and not downgraded:
+        await asyncio.to_thread(put_cached, key, call_site, model_name, text)
+
+
+async def _anext(iterator: AsyncIterator[T]) -> T:
+    return await anext(iterator)
+
+
+def iterate_sync(iterator: AsyncGenerator[T, None]) -> Iterator[T]:
+    """Iterates an async generator on the shared event loop, e.g. `gemini_stream_async`."""
+    try:
+        while True:
+            try:
+                yield run_sync(_anext(iterator))
+            except StopAsyncIteration:
+                return
+    finally:
+        run_sync(iterator.aclose())
+
+
 def ollama_structured_input(
-    system_prompt: str, user_input: str, Schema: Type[BaseModel]
+    system_prompt: str,
+    user_input: str,
+    Schema: Type[BaseModel],
+    call_site: str = "default",
 ) -> Optional[BaseModel]:
     """
     Calls Ollama with a structured output schema using the gemma3:12b model.
@@ -154,13 +835,16 @@ def ollama_structured_input(
         messages.append({"role": "system", "content": system_prompt})
     messages.append({"role": "user", "content": user_input})
 
-    response = chat(
-        messages=messages,
-        model="gemma3:4b",
-        format=Schema.model_json_schema(),
-    )
+    with _track_call("gemma3:4b", call_site, system_prompt, user_input) as call:
+        response = get_ollama_client().chat(
+            messages=messages,
+            model="gemma3:4b",
+            format=Schema.model_json_schema(),
+        )
+        call.response_bytes = payload_size(response.message.content)
 
-    try:
-        return Schema.model_validate_json(response.message.content)
-    except ValidationError:
-        return None
+        try:
+            return Schema.model_validate_json(response.message.content)
+        except ValidationError:
+            call.outcome = CallOutcome.validation_error
+            return None
@@ -0,0 +1,260 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from typing import Callable, Optional, TypeVar
+
+from google.genai import types
+from loguru import logger
+from pydantic import TypeAdapter
+
+from src.llm import (
+    BatchPending,
+    BatchRequest,
+    _gemini_config,
+    _generate_content,
+    _parse_structured,
+    collect_batch_requests,
+    get_gemini_client,
+    run_sync,
+    save_model_usage,
+)
+from src.llm_cache import put_cached
+
+T = TypeVar("T")
+
+# "gemini" submits to the Gemini Batch API, at half the price of interactive
+# calls, "local" answers the batch file with interactive calls (a stand-in for tests).
+BATCH_MODE = os.environ.get("LLM_BATCH_MODE", "gemini")
+BATCH_DIR = Path(os.environ.get("LLM_BATCH_DIR", "batch_jobs"))
+BATCH_POLL_INTERVAL = 60
+# Jobs whose code makes several LLM calls in a row need a round per call.
+MAX_BATCH_ROUNDS = 3
+LOCAL_BATCH_CONCURRENCY = 4
+
+_DONE_STATES = {
+    types.JobState.JOB_STATE_SUCCEEDED,
+    types.JobState.JOB_STATE_PARTIALLY_SUCCEEDED,
+    types.JobState.JOB_STATE_FAILED,
+    types.JobState.JOB_STATE_CANCELLED,
+    types.JobState.JOB_STATE_EXPIRED,
+}
+
+
+def _to_contents(contents) -> list[types.Content]:
+    # as the SDK reads `contents`: Contents are kept, and the strings and parts
+    # between them are joined into one user Content
+    items = contents if isinstance(contents, list) else [contents]
+    result: list[types.Content] = []
+    parts: list[types.Part] = []
+    for item in items:
+        if isinstance(item, types.Content):
+            if parts:
+                result.append(types.Content(role="user", parts=parts))
+                parts = []
+            result.append(item)
+        elif isinstance(item, str):
+            parts.append(types.Part(text=item))
+        else:
+            parts.append(types.Part.model_validate(item))
+    if parts:
+        result.append(types.Content(role="user", parts=parts))
+    return result
+
+
+def _request_line(request: BatchRequest) -> dict:
+    # the JSON of a GenerateContentRequest, as the batch file expects it
+    config = _gemini_config(request.system_prompt, request.disable_thinking)
+    generation_config = types.GenerationConfig(thinking_config=config.thinking_config)
+    if request.Schema is not None:
+        generation_config.response_mime_type = "application/json"
+        generation_config.response_json_schema = (
+            request.Schema
+            if isinstance(request.Schema, dict)
+            else TypeAdapter(request.Schema).json_schema()
+        )
+    return {
+        "key": request.key,
+        "request": {
+            "contents": [
+                content.model_dump(mode="json", exclude_none=True)
+                for content in _to_contents(request.contents)
+            ],
+            "system_instruction": types.Content(
+                parts=[types.Part(text=request.system_prompt)]
+            ).model_dump(mode="json", exclude_none=True),
+            "generation_config": generation_config.model_dump(
+                mode="json", exclude_none=True
+            ),
+        },
+    }
+
+
+def write_batch_file(requests: list[BatchRequest], model_name: str) -> Path:
+    """
+    Writes the requests as JSON lines to BATCH_DIR. The name is a hash of the
+    request keys, so the same requests always map to the same file.
+    """
+    BATCH_DIR.mkdir(parents=True, exist_ok=True)
+    digest = hashlib.sha256(
+        "".join(sorted(request.key for request in requests)).encode()
+    ).hexdigest()[:16]
+    path = BATCH_DIR / f"{model_name}-{digest}.jsonl"
+    with path.open("w") as f:
+        for request in requests:
+            f.write(json.dumps(_request_line(request), ensure_ascii=False) + "\n")
+    return path
+
+
+def _submit_gemini(path: Path, model_name: str) -> Path:
+    job_file = path.with_suffix(".job")
+    client = get_gemini_client()
+    if job_file.exists():
+        # resumes a job submitted by an earlier, interrupted run
+        job = client.batches.get(name=job_file.read_text())
+        logger.info(f"Resuming batch job {job.name}")
+    else:
+        uploaded = client.files.upload(
+            file=path,
+            config=types.UploadFileConfig(
+                display_name=path.stem, mime_type="application/jsonl"
+            ),
+        )
+        job = client.batches.create(
+            model=model_name,
+            src=uploaded.name,
+            config=types.CreateBatchJobConfig(display_name=path.stem),
+        )
+        job_file.write_text(job.name)
+        logger.info(f"Submitted {path} as batch job {job.name}")
+
+    while job.state not in _DONE_STATES:
+        time.sleep(BATCH_POLL_INTERVAL)
+        job = client.batches.get(name=job.name)
+        logger.debug(f"Batch job {job.name} is {job.state}")
+    if job.state not in (
+        types.JobState.JOB_STATE_SUCCEEDED,
+        types.JobState.JOB_STATE_PARTIALLY_SUCCEEDED,
+    ):
+        job_file.unlink()
+        raise RuntimeError(f"Batch job {job.name} ended as {job.state} - {job.error}")
+
+    results = path.with_suffix(".results.jsonl")
+    results.write_bytes(client.files.download(file=job.dest.file_name))
+    job_file.unlink()
+    return results
+
+
+async def _answer_locally(path: Path, model_name: str) -> Path:
+    semaphore = asyncio.Semaphore(LOCAL_BATCH_CONCURRENCY)
+
+    async def answer(line: dict) -> dict:
+        request = line["request"]
+        config = types.GenerateContentConfig(
+            system_instruction=request["system_instruction"],
+            **request["generation_config"],
+        )
+        async with semaphore:
+            try:
+                response = await _generate_content(
+                    model_name, config, request["contents"], timeout=None
+                )
+            except Exception as e:
+                return {"key": line["key"], "error": {"message": repr(e)}}
+        return {
+            "key": line["key"],
+            "response": response.model_dump(mode="json", exclude_none=True),
+        }
+
+    lines = [json.loads(line) for line in path.read_text().splitlines()]
+    results = path.with_suffix(".results.jsonl")
+    with results.open("w") as f:
+        for result in await asyncio.gather(*map(answer, lines)):
+            f.write(json.dumps(result, ensure_ascii=False) + "\n")
+    return results
+
+
+def _write_back(
+    results: Path, requests: dict[str, BatchRequest], record_usage: bool
+) -> int:
+    """Puts the valid responses into the response cache. Returns their number."""
+    n_cached = 0
+    for line in results.read_text().splitlines():
+        result = json.loads(line)
+        request = requests.get(result["key"])
+        if request is None:
+            continue
+        if "response" not in result:
+            logger.warning(
+                f"Batch request {result['key']} failed - {result.get('error')}"
+            )
+            continue
+        response = types.GenerateContentResponse.model_validate(result["response"])
+        if record_usage:
+            # the local stand-in recorded the usage when it made the call
+            save_model_usage(response, request.model_name)
+        if not response.text:
+            continue
+        if request.Schema is not None:
+            try:
+                _parse_structured(request.Schema, response.text)
+            except Exception as e:
+                logger.warning(f"Invalid batch response for {result['key']} - {e}")
+                continue
+        put_cached(result["key"], request.call_site, request.model_name, response.text)
+        n_cached += 1
+    return n_cached
+
+
+def run_batch(requests: dict[str, BatchRequest], mode: str = BATCH_MODE) -> int:
+    """
+    Answers the requests in one batch job per model, waits for them and writes
+    the responses to the response cache. Returns the number of cached responses.
+    """
+    n_cached = 0
+    by_model: dict[str, list[BatchRequest]] = {}
+    for request in requests.values():
+        by_model.setdefault(request.model_name, []).append(request)
+    for model_name, model_requests in by_model.items():
+        path = write_batch_file(model_requests, model_name)
+        if mode == "gemini":
+            results = _submit_gemini(path, model_name)
+        else:
+            results = run_sync(_answer_locally(path, model_name))
+        n_cached += _write_back(results, requests, record_usage=mode == "gemini")
+    return n_cached
+
+
+def run_batched(
+    jobs: list[Callable[[], T]], mode: str = BATCH_MODE
+) -> list[Optional[T]]:
+    """
+    Runs `jobs`, functions whose LLM calls go through the response cache (e.g.
+    the task `generate` classmethods), with their requests sent as batch jobs:
+    the jobs run once to collect the requests, the batch answers them into the
+    cache, and the jobs run again. Repeated for jobs that make another request
+    after the first. Returns the result of every job, None if it failed.
+    """
+    results: dict[int, Optional[T]] = {}
+    for round_ in range(MAX_BATCH_ROUNDS + 1):
+        last_round = round_ == MAX_BATCH_ROUNDS
+        with collect_batch_requests() as requests:
+            for i, job in enumerate(jobs):
+                if i in results:
+                    continue
+                try:
+                    results[i] = job()
+                except BatchPending:
+                    if last_round:
+                        results[i] = None
+                except Exception as e:
+                    logger.exception(f"Batched job {i} failed - {e}")
+                    results[i] = None
+        if not requests or last_round:
+            break
+        logger.info(f"Batch round {round_ + 1}: {len(requests)} requests")
+        n_cached = run_batch(requests, mode)
+        logger.info(f"Batch round {round_ + 1}: cached {n_cached} responses")
+    return [results.get(i) for i in range(len(jobs))]
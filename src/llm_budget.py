@@ -0,0 +1,285 @@
+import asyncio
+import os
+import threading
+import time
+from collections import defaultdict
+from datetime import date, datetime
+from enum import StrEnum
+from typing import Any, Optional, Sequence
+
+from loguru import logger
+from sqlalchemy import text
+from sqlalchemy.dialects.sqlite import insert
+from sqlmodel import Field, Session, SQLModel, select
+
+from src.db import engine
+
+
+class RollupPeriod(StrEnum):
+    hour = "hour"
+    day = "day"
+
+
+class UsageRollup(SQLModel, table=True):
+    """ModelUsage summed per model and hour or day, kept up to date by the usage writer."""
+
+    __table_args__ = {"extend_existing": True}
+
+    period: RollupPeriod = Field(primary_key=True)
+    bucket_start: datetime = Field(primary_key=True)
+    model_name: str = Field(primary_key=True)
+    calls: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+
+
+def _bucket_start(usage_time: datetime, period: RollupPeriod) -> datetime:
+    if period == RollupPeriod.day:
+        return datetime.combine(usage_time.date(), datetime.min.time())
+    return usage_time.replace(minute=0, second=0, microsecond=0)
+
+
+def add_to_rollups(sess: Session, usages: Sequence[Any]) -> None:
+    """
+    Adds ModelUsage rows to the hourly and daily rollups, in the transaction of `sess`.
+    """
+    totals: dict[tuple[RollupPeriod, datetime, str], list[int]] = defaultdict(
+        lambda: [0, 0, 0]
+    )
+    for usage in usages:
+        for period in RollupPeriod:
+            total = totals[
+                (period, _bucket_start(usage.usage_time, period), usage.model_name)
+            ]
+            total[0] += 1
+            total[1] += usage.input_tokens
+            total[2] += usage.output_tokens
+    if not totals:
+        return
+
+    stmt = insert(UsageRollup).values(
+        [
+            {
+                "period": period,
+                "bucket_start": bucket_start,
+                "model_name": model_name,
+                "calls": calls,
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens,
+            }
+            for (period, bucket_start, model_name), (
+                calls,
+                input_tokens,
+                output_tokens,
+            ) in totals.items()
+        ]
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["period", "bucket_start", "model_name"],
+        set_={
+            "calls": UsageRollup.calls + stmt.excluded.calls,
+            "input_tokens": UsageRollup.input_tokens + stmt.excluded.input_tokens,
+            "output_tokens": UsageRollup.output_tokens + stmt.excluded.output_tokens,
+        },
+    )
+    sess.exec(stmt)
+
+
+_backfilled = False
+_backfill_lock = threading.Lock()
+
+
+def backfill_rollups() -> None:
+    """
+    Rebuilds the rollups from all ModelUsage rows if they do not add up to
+    them, e.g. after rows were written before the rollups existed. Checked once
+    per process, before the rollups are first read.
+    """
+    global _backfilled
+    with _backfill_lock:
+        if _backfilled:
+            return
+        with Session(engine) as sess:
+            # the usage writer adds rows and rollups in one transaction, so
+            # the counts only differ for rows that were never rolled up
+            n_usages = sess.exec(text("SELECT count(*) FROM modelusage")).one()[0]
+            n_rolled_up = sess.exec(
+                text(
+                    "SELECT coalesce(sum(calls), 0) FROM usagerollup"
+                    " WHERE period = :period"
+                ),
+                params={"period": RollupPeriod.day.name},
+            ).one()[0]
+            if n_usages != n_rolled_up:
+                logger.info(f"Rebuilding the usage rollups of {n_usages} rows")
+                sess.exec(text("DELETE FROM usagerollup"))
+                for period, bucket in (
+                    (RollupPeriod.hour, "%Y-%m-%d %H:00:00.000000"),
+                    (RollupPeriod.day, "%Y-%m-%d 00:00:00.000000"),
+                ):
+                    sess.exec(
+                        text(
+                            "INSERT INTO usagerollup"
+                            " (period, bucket_start, model_name, calls, input_tokens, output_tokens)"
+                            " SELECT :period, strftime(:bucket, usage_time), model_name,"
+                            " count(*), sum(input_tokens), sum(output_tokens)"
+                            " FROM modelusage GROUP BY 2, 3"
+                        ),
+                        params={"period": period.name, "bucket": bucket},
+                    )
+                sess.commit()
+        _backfilled = True
+
+
+def get_rollups(
+    period: RollupPeriod = RollupPeriod.day, since: Optional[datetime] = None
+) -> list[UsageRollup]:
+    backfill_rollups()
+    stmt = select(UsageRollup).where(UsageRollup.period == period)
+    if since is not None:
+        stmt = stmt.where(UsageRollup.bucket_start >= _bucket_start(since, period))
+    with Session(engine) as sess:
+        return sess.exec(stmt.order_by(UsageRollup.bucket_start)).all()
+
+
+def _parse_budgets(spec: str) -> dict[str, int]:
+    # "model=tokens,model=tokens"
+    budgets = {}
+    for item in filter(None, spec.split(",")):
+        model_name, tokens = item.split("=")
+        budgets[model_name.strip()] = int(tokens)
+    return budgets
+
+
+# Daily token budgets (input + output tokens), over all models and per model.
+# Unset means unlimited.
+DAILY_TOKEN_BUDGET: Optional[int] = (
+    int(os.environ["LLM_DAILY_TOKEN_BUDGET"])
+    if os.environ.get("LLM_DAILY_TOKEN_BUDGET")
+    else None
+)
+MODEL_DAILY_TOKEN_BUDGETS = _parse_budgets(
+    os.environ.get("LLM_MODEL_TOKEN_BUDGETS", "")
+)
+# A model over its budget is replaced by its downgrade, if that one is within budget.
+DOWNGRADES = {
+    "gemini-2.5-flash-preview-05-20": "gemini-2.0-flash",
+    "gemini-2.0-flash": "gemini-2.0-flash-lite",
+}
+# How often the usage of other processes is read from the daily rollup, in seconds.
+BUDGET_SYNC_INTERVAL = 30
+
+
+class BudgetExceededError(RuntimeError):
+    pass
+
+
+class TokenBudget:
+    """
+    Today's token usage per model, kept in memory so budgets are checked with a
+    few dict lookups. Usage of this process is counted as it is recorded; usage
+    of other processes is picked up from the daily rollup every
+    BUDGET_SYNC_INTERVAL seconds.
+    """
+
+    def __init__(
+        self, daily_budget: Optional[int], model_budgets: dict[str, int]
+    ) -> None:
+        self.daily_budget = daily_budget
+        self.model_budgets = model_budgets
+        self._lock = threading.Lock()
+        self._day: Optional[date] = None
+        self._synced_at = 0.0
+        self._flushed: dict[str, int] = defaultdict(int)
+        self._pending: dict[str, int] = defaultdict(int)
+
+    @property
+    def enabled(self) -> bool:
+        return self.daily_budget is not None or bool(self.model_budgets)
+
+    def _read_rollup(self) -> list[tuple[str, int]]:
+        backfill_rollups()
+        with Session(engine) as sess:
+            return sess.exec(
+                select(
+                    UsageRollup.model_name,
+                    UsageRollup.input_tokens + UsageRollup.output_tokens,
+                ).where(
+                    UsageRollup.period == RollupPeriod.day,
+                    UsageRollup.bucket_start
+                    == _bucket_start(datetime.now(), RollupPeriod.day),
+                )
+            ).all()
+
+    async def _sync(self) -> None:
+        today = date.today()
+        with self._lock:
+            if (
+                today == self._day
+                and time.monotonic() - self._synced_at < BUDGET_SYNC_INTERVAL
+            ):
+                return
+            # concurrent calls do not read the rollup again
+            self._synced_at = time.monotonic()
+        rows = await asyncio.to_thread(self._read_rollup)
+        with self._lock:
+            if today != self._day:
+                self._pending.clear()
+                self._flushed.clear()
+            self._day = today
+            # rows flushed by this process while the rollup was read are in
+            # `_flushed` but maybe not in `rows`, so the larger count is kept
+            for model_name, tokens in rows:
+                self._flushed[model_name] = max(self._flushed[model_name], tokens)
+
+    def record(self, model_name: str, tokens: int) -> None:
+        """Counts tokens of this process that are not in the rollup yet."""
+        with self._lock:
+            self._pending[model_name] += tokens
+
+    def on_flushed(self, usages: Sequence[Any]) -> None:
+        """Moves the tokens of ModelUsage rows written to the rollup from pending to flushed."""
+        with self._lock:
+            for usage in usages:
+                if usage.usage_time.date() != self._day:
+                    continue
+                tokens = usage.input_tokens + usage.output_tokens
+                self._pending[usage.model_name] -= tokens
+                self._flushed[usage.model_name] += tokens
+
+    def used(self, model_name: Optional[str] = None) -> int:
+        with self._lock:
+            if model_name is not None:
+                return self._flushed[model_name] + self._pending[model_name]
+            return sum(self._flushed.values()) + sum(self._pending.values())
+
+    async def resolve_model(self, model_name: str) -> str:
+        """
+        The model to call instead of `model_name`: itself, or a downgrade if it is
+        over its budget. Raises BudgetExceededError if no model is within budget.
+        """
+        if not self.enabled:
+            return model_name
+        await self._sync()
+
+        if self.daily_budget is not None and self.used() >= self.daily_budget:
+            raise BudgetExceededError(
+                f"Daily token budget of {self.daily_budget} is exhausted"
+            )
+
+        requested = model_name
+        while model_name in self.model_budgets and (
+            self.used(model_name) >= self.model_budgets[model_name]
+        ):
+            if model_name not in DOWNGRADES:
+                raise BudgetExceededError(
+                    f"Daily token budget of {requested} is exhausted"
+                )
+            model_name = DOWNGRADES[model_name]
+
+        if model_name != requested:
+            logger.warning(f"{requested} is over budget, using {model_name}")
+        return model_name
+
+
+token_budget = TokenBudget(DAILY_TOKEN_BUDGET, MODEL_DAILY_TOKEN_BUDGETS)
@@ -0,0 +1,208 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import IO, Any, Optional
+
+from loguru import logger
+from pydantic import BaseModel, TypeAdapter
+from sqlalchemy import delete, func
+from sqlmodel import Field, Session, SQLModel, select
+
+from src.db import engine
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: identical requests are only coalesced within a process
+    fcntl = None
+
+# Seconds a response stays valid, per call site. None never expires.
+DEFAULT_TTL = 24 * 3600
+CACHE_TTLS: dict[str, Optional[float]] = {
+    "planner": 3600,
+    "critic": 3600,
+    "card_chat": 3600,
+    "summary": 24 * 3600,
+    "drag_and_drop": 7 * 24 * 3600,
+    "fill_in": 7 * 24 * 3600,
+    "sentence_order": 7 * 24 * 3600,
+    "vocab": 7 * 24 * 3600,
+}
+MAX_CACHE_BYTES = int(os.environ.get("LLM_CACHE_MAX_BYTES", 50 * 1024**2))
+CACHE_DISABLED = os.environ.get("LLM_CACHE_DISABLED", "0") == "1"
+# Lock files of the requests processes are sending, see `try_lock_inflight`.
+INFLIGHT_LOCK_DIR = Path(tempfile.gettempdir()) / "language_teacher_llm_inflight"
+
+
+class LLMCacheEntry(SQLModel, table=True):
+    __table_args__ = {"extend_existing": True}
+
+    key: str = Field(primary_key=True)
+    call_site: str = Field(index=True)
+    model_name: str
+    response: str
+    size: int
+    created_at: datetime
+    expires_at: Optional[datetime] = Field(None, index=True)
+    last_used_at: datetime = Field(index=True)
+
+
+_stats: Counter = Counter()
+_stats_lock = threading.Lock()
+
+
+def _normalize(contents: Any) -> Any:
+    if isinstance(contents, str):
+        return " ".join(contents.split())
+    if isinstance(contents, BaseModel):
+        return _normalize(contents.model_dump(mode="json", exclude_none=True))
+    if isinstance(contents, dict):
+        return {k: _normalize(v) for k, v in contents.items()}
+    if isinstance(contents, (list, tuple)):
+        return [_normalize(item) for item in contents]
+    if isinstance(contents, bytes):
+        return hashlib.sha256(contents).hexdigest()
+    return contents
+
+
+def schema_fingerprint(Schema: Any) -> Optional[str]:
+    if Schema is None:
+        return None
+    json_schema = (
+        Schema if isinstance(Schema, dict) else TypeAdapter(Schema).json_schema()
+    )
+    return hashlib.sha256(json.dumps(json_schema, sort_keys=True).encode()).hexdigest()
+
+
+def cache_key(
+    model_name: str, system_prompt: str, contents: Any, Schema: Any = None, **config
+) -> str:
+    """
+    Key of a request: model, system prompt, whitespace-normalized contents,
+    response schema and any further config that changes the answer.
+    """
+    payload = json.dumps(
+        [
+            model_name,
+            system_prompt,
+            _normalize(contents),
+            schema_fingerprint(Schema),
+            _normalize(config),
+        ],
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def count_event(event: str, call_site: str) -> None:
+    with _stats_lock:
+        _stats[event] += 1
+        _stats[f"{call_site}.{event}"] += 1
+
+
+def cache_stats() -> dict[str, int]:
+    """Hits and misses of this process, in total and per call site."""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def get_cached(key: str, call_site: str, record: bool = True) -> Optional[str]:
+    """The cached response, or None. `record` counts the lookup as hit or miss."""
+    now = datetime.now()
+    with Session(engine) as sess:
+        entry = sess.get(LLMCacheEntry, key)
+        if entry is None or (entry.expires_at and entry.expires_at < now):
+            if record:
+                count_event("misses", call_site)
+            return None
+        entry.last_used_at = now
+        sess.add(entry)
+        sess.commit()
+        if record:
+            count_event("hits", call_site)
+        return entry.response
+
+
+def put_cached(key: str, call_site: str, model_name: str, response: str) -> None:
+    """
+    Stores a response, then evicts expired entries and, while the cache is larger
+    than MAX_CACHE_BYTES, the least recently used ones.
+    """
+    now = datetime.now()
+    ttl = CACHE_TTLS.get(call_site, DEFAULT_TTL)
+    with Session(engine) as sess:
+        sess.merge(
+            LLMCacheEntry(
+                key=key,
+                call_site=call_site,
+                model_name=model_name,
+                response=response,
+                size=len(response.encode()),
+                created_at=now,
+                expires_at=now + timedelta(seconds=ttl) if ttl is not None else None,
+                last_used_at=now,
+            )
+        )
+        sess.exec(delete(LLMCacheEntry).where(LLMCacheEntry.expires_at < now))
+
+        total = sess.exec(select(func.coalesce(func.sum(LLMCacheEntry.size), 0))).one()
+        if total > MAX_CACHE_BYTES:
+            for entry in sess.exec(
+                select(LLMCacheEntry).order_by(LLMCacheEntry.last_used_at)
+            ):
+                if total <= MAX_CACHE_BYTES:
+                    break
+                total -= entry.size
+                sess.delete(entry)
+            logger.debug(f"Evicted LLM cache down to {total} bytes")
+        sess.commit()
+
+
+def delete_cached(key: str) -> None:
+    with Session(engine) as sess:
+        sess.exec(delete(LLMCacheEntry).where(LLMCacheEntry.key == key))
+        sess.commit()
+
+
+def try_lock_inflight(key: str) -> Optional[IO]:
+    """
+    Locks the lock file of request `key`, unless another process holds it.
+    Returns the open file, which holds the lock until `unlock_inflight`, or None.
+    The OS releases the lock of a process that dies.
+    """
+    path = INFLIGHT_LOCK_DIR / key
+    if fcntl is None:
+        return open(os.devnull, "a")
+    INFLIGHT_LOCK_DIR.mkdir(parents=True, exist_ok=True)
+    file = open(path, "a")
+    try:
+        fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        # the previous holder removes the file when it is done, so the lock may
+        # be on a removed file, while another process locked a new one
+        locked, current = os.fstat(file.fileno()), os.stat(path)
+        if (locked.st_dev, locked.st_ino) != (current.st_dev, current.st_ino):
+            file.close()
+            return None
+    except (BlockingIOError, FileNotFoundError):
+        file.close()
+        return None
+    return file
+
+
+def unlock_inflight(key: str, file: IO) -> None:
+    if fcntl is not None:
+        # removed while still locked, see the check in `try_lock_inflight`
+        (INFLIGHT_LOCK_DIR / key).unlink(missing_ok=True)
+    file.close()
+
+
+def clear_cache() -> None:
+    with Session(engine) as sess:
+        sess.exec(delete(LLMCacheEntry))
+        sess.commit()
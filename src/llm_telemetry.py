@@ -0,0 +1,114 @@
+import math
+from collections import defaultdict
+from contextvars import ContextVar
+from datetime import datetime
+from enum import StrEnum
+from typing import Any, Literal, Optional
+
+from pydantic import BaseModel
+from sqlalchemy import case, func
+from sqlmodel import Field, Session, SQLModel, select
+
+from src.db import engine
+
+# Attempt number of the current call, set by `retry_n_times`.
+retry_attempt: ContextVar[int] = ContextVar("retry_attempt", default=1)
+
+
+class CallOutcome(StrEnum):
+    ok = "ok"
+    cache_hit = "cache_hit"
+    empty = "empty"
+    timeout = "timeout"
+    validation_error = "validation_error"
+    over_budget = "over_budget"
+    cancelled = "cancelled"
+    error = "error"
+
+
+class LLMCall(SQLModel, table=True):
+    """One Gemini or Ollama call, or a response served from the cache."""
+
+    __table_args__ = {"extend_existing": True}
+
+    id: Optional[int] = Field(None, primary_key=True)
+    model_name: str = Field(index=True)
+    call_site: str = Field(index=True)
+    started_at: datetime = Field(index=True)
+    wall_time_ms: float = 0.0
+    outcome: CallOutcome = CallOutcome.ok
+    attempt: int = 1
+    request_bytes: int = 0
+    response_bytes: Optional[int] = None
+
+
+def payload_size(payload: Any) -> int:
+    """Approximate size in bytes of a prompt, its contents or a response."""
+    if payload is None:
+        return 0
+    if isinstance(payload, str):
+        return len(payload.encode())
+    if isinstance(payload, bytes):
+        return len(payload)
+    if isinstance(payload, BaseModel):
+        return payload_size(payload.model_dump(exclude_none=True))
+    if isinstance(payload, dict):
+        return sum(payload_size(value) for value in payload.values())
+    if isinstance(payload, (list, tuple)):
+        return sum(payload_size(item) for item in payload)
+    return len(str(payload))
+
+
+def _percentile(sorted_values: list[float], q: float) -> float:
+    # nearest rank
+    return sorted_values[max(0, math.ceil(q * len(sorted_values)) - 1)]
+
+
+def latency_report(
+    since: datetime,
+    group_by: Literal["model_name", "call_site"] = "call_site",
+) -> list[dict[str, Any]]:
+    """
+    Per model or call site, over the calls started since `since`: number of
+    calls, failure rate and p50/p95/p99 wall time in ms. Calls answered by the
+    cache only count as `cache_hits`. Counts are aggregated by the database,
+    only the wall times of the sent calls are loaded for the percentiles.
+    """
+    key = getattr(LLMCall, group_by)
+    sent = LLMCall.outcome != CallOutcome.cache_hit
+    counts = (
+        select(
+            key,
+            func.count(),
+            func.sum(case((sent, 1), else_=0)),
+            func.sum(case((sent & (LLMCall.outcome != CallOutcome.ok), 1), else_=0)),
+            func.sum(case((sent & (LLMCall.attempt > 1), 1), else_=0)),
+        )
+        .where(LLMCall.started_at >= since)
+        .group_by(key)
+        .order_by(key)
+    )
+    wall_times_stmt = (
+        select(key, LLMCall.wall_time_ms)
+        .where(LLMCall.started_at >= since, sent)
+        .order_by(key, LLMCall.wall_time_ms)
+    )
+    with Session(engine) as sess:
+        rows = sess.exec(counts).all()
+        wall_times: dict[str, list[float]] = defaultdict(list)
+        for name, wall_time in sess.exec(wall_times_stmt):
+            wall_times[name].append(wall_time)
+
+    report = []
+    for name, total, n_sent, failures, retries in rows:
+        row = {
+            group_by: name,
+            "calls": n_sent,
+            "cache_hits": total - n_sent,
+            "failure_rate": failures / n_sent if n_sent else 0.0,
+            "retries": retries,
+        }
+        for label, q in (("p50_ms", 0.5), ("p95_ms", 0.95), ("p99_ms", 0.99)):
+            row[label] = _percentile(wall_times[name], q) if wall_times[name] else None
+        report.append(row)
+    return report
@@ -0,0 +1,168 @@
+import hashlib
+import io
+import os
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Optional
+
+from google.genai import types
+from loguru import logger
+
+from src.llm import get_gemini_client
+from src.media_processing import TEXT_MIME_TYPE, media_pool, prepare_media
+from src.uploads import upload_digest
+
+# "gemini" uploads media once through the Files API, "local" keeps sending it
+# inline (a stand-in for tests and offline use), both deduplicate by content hash.
+MEDIA_UPLOAD_MODE = os.environ.get("LLM_MEDIA_UPLOAD", "gemini")
+# Gemini deletes uploaded files after 48 hours, they are uploaded again a bit earlier
+MEDIA_UPLOAD_TTL = 47 * 3600
+# seconds until a failed upload is tried again
+MEDIA_RETRY_AFTER = 600
+MEDIA_PROCESSING_TIMEOUT = 60
+# downscale and recompress images and rasterize PDFs before sending them
+MEDIA_OPTIMIZE = os.environ.get("LLM_MEDIA_OPTIMIZE", "1") == "1"
+# send the text of PDFs and clean screenshots instead of images
+MEDIA_EXTRACT_TEXT = os.environ.get("LLM_MEDIA_EXTRACT_TEXT", "1") == "1"
+
+
+@dataclass
+class _Media:
+    parts: list[types.Part]
+    expires_at: float
+
+
+def mime_type_of(file_name: str) -> str:
+    ext = file_name.split(".")[-1].lower().replace("jpg", "jpeg")
+    return "application/pdf" if ext == "pdf" else f"image/{ext}"
+
+
+class MediaRegistry:
+    """
+    Uploads every distinct image or PDF once and hands out Parts referencing it,
+    so the bytes are not sent again with every message. Media is keyed by the
+    sha256 of its content, so the same file uploaded twice is only stored once.
+    Before the upload it is prepared on the media process pool, see
+    `prepare_media`: text that can be extracted reliably is sent as text, the
+    rest as optimized images. If an upload fails the media is sent inline.
+    """
+
+    def __init__(
+        self,
+        mode: str = MEDIA_UPLOAD_MODE,
+        optimize: bool = MEDIA_OPTIMIZE,
+        extract_text: bool = MEDIA_EXTRACT_TEXT,
+    ) -> None:
+        self.mode = mode
+        self.optimize = optimize
+        self.extract_text = extract_text
+        self._media: dict[str, _Media] = {}
+        self._preparing: dict[str, Future] = {}
+        self._locks: dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def parts(
+        self, data: bytes, mime_type: str, digest: Optional[str] = None
+    ) -> list[types.Part]:
+        digest = digest or hashlib.sha256(data).hexdigest()
+        with self._lock:
+            lock = self._locks.setdefault(digest, threading.Lock())
+        with lock:
+            media = self._media.get(digest)
+            if media is None or media.expires_at < time.monotonic():
+                parts = [
+                    types.Part(text=f"Text of an uploaded file:\n{item.decode()}")
+                    if item_mime_type == TEXT_MIME_TYPE
+                    else self._upload(item, item_mime_type, f"{digest[:16]}-{i}")
+                    for i, (item, item_mime_type) in enumerate(
+                        self._prepared(data, mime_type, digest)
+                    )
+                ]
+                uploaded = self.mode != "gemini" or all(
+                    part.inline_data is None for part in parts
+                )
+                media = _Media(
+                    parts,
+                    time.monotonic()
+                    + (MEDIA_UPLOAD_TTL if uploaded else MEDIA_RETRY_AFTER),
+                )
+                self._media[digest] = media
+            return media.parts
+
+    def prefetch(self, data: bytes, mime_type: str, digest: str) -> None:
+        """Starts preparing media that is not registered, or whose entry expired."""
+        if not (self.optimize or self.extract_text):
+            return
+        with self._lock:
+            media = self._media.get(digest)
+            if media is not None and media.expires_at >= time.monotonic():
+                return
+            if digest in self._preparing:
+                return
+            self._preparing[digest] = media_pool().submit(
+                prepare_media, data, mime_type, self.optimize, self.extract_text
+            )
+
+    def prefetch_uploads(self, files) -> None:
+        """Starts preparing streamlit UploadedFiles, so they are processed in parallel."""
+        for file in files:
+            self.prefetch(file.getvalue(), mime_type_of(file.name), upload_digest(file))
+
+    def upload_parts(self, file) -> list[types.Part]:
+        """Parts of a streamlit UploadedFile."""
+        return self.parts(file.getvalue(), mime_type_of(file.name), upload_digest(file))
+
+    def _prepared(
+        self, data: bytes, mime_type: str, digest: str
+    ) -> list[tuple[bytes, str]]:
+        if not (self.optimize or self.extract_text):
+            return [(data, mime_type)]
+        self.prefetch(data, mime_type, digest)
+        with self._lock:
+            future = self._preparing.pop(digest, None)
+        if future is None:
+            # the entry expired between the check in `parts` and the prefetch
+            future = media_pool().submit(
+                prepare_media, data, mime_type, self.optimize, self.extract_text
+            )
+        try:
+            prepared = future.result()
+        except Exception as e:
+            logger.warning(f"Preparing media failed, sending the original - {e!r}")
+            return [(data, mime_type)]
+        logger.debug(
+            f"Prepared {len(data)} bytes of {mime_type} as"
+            f" {[(len(item), item_mime_type) for item, item_mime_type in prepared]}"
+        )
+        return prepared
+
+    def _upload(self, data: bytes, mime_type: str, name: str) -> types.Part:
+        inline = types.Part.from_bytes(data=data, mime_type=mime_type)
+        if self.mode != "gemini":
+            return inline
+        try:
+            client = get_gemini_client()
+            file = client.files.upload(
+                file=io.BytesIO(data),
+                config=types.UploadFileConfig(
+                    mime_type=mime_type, display_name=f"media-{name}"
+                ),
+            )
+            deadline = time.monotonic() + MEDIA_PROCESSING_TIMEOUT
+            while file.state == types.FileState.PROCESSING:
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"{file.name} is still processing")
+                time.sleep(0.5)
+                file = client.files.get(name=file.name)
+            if file.state == types.FileState.FAILED:
+                raise RuntimeError(f"Processing {file.name} failed - {file.error}")
+            logger.debug(f"Uploaded {len(data)} bytes of {mime_type} as {file.name}")
+            return types.Part.from_uri(file_uri=file.uri, mime_type=mime_type)
+        except Exception as e:
+            logger.warning(f"Uploading media failed, sending it inline - {e!r}")
+            return inline
+
+
+media_registry = MediaRegistry()
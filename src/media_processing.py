@@ -0,0 +1,181 @@
+import io
+import multiprocessing
+import os
+import shutil
+import subprocess
+import threading
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from pdf2image import convert_from_bytes
+from PIL import Image, ImageOps
+from pypdf import PdfReader, PdfWriter
+
+# Gemini bills an image as 258 tokens per 768px tile it is cropped into. A
+# 1536px photo is 4-6 tiles (about 1000-1500 tokens) and keeps handwriting
+# legible; larger photos cost the same but are bigger to send.
+MAX_IMAGE_SIDE = 1536
+IMAGE_QUALITY = 80
+# A native PDF page is also billed as 258 tokens. A page rasterized to at most
+# 768px is a single tile, so it costs the same; a larger one would cost 4-6
+# times as much. A PDF whose pages are smaller as images is sent as images.
+MAX_PDF_PAGE_SIDE = 768
+PDF_DPI = 150
+MEDIA_WORKERS = 2
+
+# A PDF page is sent as text if its text layer has at least this many
+# characters, and almost all of them are ordinary text.
+MIN_TEXT_CHARS = 80
+MIN_TEXT_RATIO = 0.9
+# Images are OCRed with tesseract, if it is installed, and sent as text if the
+# mean word confidence is at least this high.
+OCR_MIN_CONFIDENCE = 90
+OCR_LANGUAGES = os.environ.get("LLM_OCR_LANGUAGES", "spa+deu+eng")
+TEXT_MIME_TYPE = "text/plain"
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def media_pool() -> ProcessPoolExecutor:
+    """The process pool for image work, shared by the media registry and thumbnails."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn, forking the threaded streamlit server is unsafe
+            _pool = ProcessPoolExecutor(
+                MEDIA_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _pool
+
+
+def _encode(image: Image.Image, max_side: int = MAX_IMAGE_SIDE) -> bytes:
+    image = image.convert("RGB")
+    image.thumbnail((max_side, max_side))
+    buffer = io.BytesIO()
+    image.save(buffer, format="WEBP", quality=IMAGE_QUALITY)
+    return buffer.getvalue()
+
+
+def _pdf_page_images(data: bytes, **page_range) -> list[bytes]:
+    pages = convert_from_bytes(data, dpi=PDF_DPI, size=MAX_PDF_PAGE_SIDE, **page_range)
+    return [_encode(page, MAX_PDF_PAGE_SIDE) for page in pages]
+
+
+def optimize_media(data: bytes, mime_type: str) -> list[tuple[bytes, str]]:
+    """
+    Rasterizes a PDF into one image per page of at most MAX_PDF_PAGE_SIDE, and
+    downscales images to at most MAX_IMAGE_SIDE and recompresses them as WebP.
+    A PDF or image that would not get smaller is kept as it is. Returns
+    (data, mime type) pairs. Needs poppler for PDFs.
+    """
+    if mime_type == "application/pdf":
+        pages = _pdf_page_images(data)
+        if sum(map(len, pages)) >= len(data):
+            return [(data, mime_type)]
+        return [(page, "image/webp") for page in pages]
+
+    image = Image.open(io.BytesIO(data))
+    size = image.size
+    # lets JPEGs decode at a fraction of their size, much faster
+    image.draft("RGB", (MAX_IMAGE_SIDE, MAX_IMAGE_SIDE))
+    optimized = _encode(ImageOps.exif_transpose(image))
+    if len(optimized) >= len(data) and max(size) <= MAX_IMAGE_SIDE:
+        return [(data, mime_type)]
+    return [(optimized, "image/webp")]
+
+
+def split_pdf(data: bytes, pages_per_part: int) -> list[bytes]:
+    """Splits a PDF into PDFs of `pages_per_part` consecutive pages."""
+    reader = PdfReader(io.BytesIO(data))
+    parts = []
+    for start in range(0, len(reader.pages), pages_per_part):
+        writer = PdfWriter()
+        for page in reader.pages[start : start + pages_per_part]:
+            writer.add_page(page)
+        buffer = io.BytesIO()
+        writer.write(buffer)
+        parts.append(buffer.getvalue())
+    return parts
+
+
+def _is_legible(text: str) -> bool:
+    # garbled text layers are full of private use and replacement characters
+    chars = [c for c in text if not c.isspace()]
+    if len(chars) < MIN_TEXT_CHARS:
+        return False
+    # letters, numbers and punctuation
+    ordinary = sum(unicodedata.category(c)[0] in "LNP" for c in chars)
+    return ordinary / len(chars) >= MIN_TEXT_RATIO
+
+
+def pdf_text_pages(data: bytes) -> list[str]:
+    """The text layer of every page of a PDF. Needs poppler's pdftotext."""
+    result = subprocess.run(
+        ["pdftotext", "-layout", "-enc", "UTF-8", "-", "-"],
+        input=data,
+        capture_output=True,
+        check=True,
+        timeout=60,
+    )
+    # pages end with a form feed
+    return result.stdout.decode().split("\f")[:-1]
+
+
+def ocr_text(data: bytes) -> tuple[str, float]:
+    """
+    The text of an image and the mean confidence of its words, from 0 to 100.
+    Needs tesseract.
+    """
+    result = subprocess.run(
+        ["tesseract", "stdin", "stdout", "-l", OCR_LANGUAGES, "tsv"],
+        input=data,
+        capture_output=True,
+        check=True,
+        timeout=60,
+    )
+    lines: dict[tuple[str, str, str], list[str]] = {}
+    confidences = []
+    for row in result.stdout.decode().splitlines()[1:]:
+        cols = row.split("\t")
+        if len(cols) < 12 or not cols[11].strip() or float(cols[10]) < 0:
+            continue
+        lines.setdefault((cols[2], cols[3], cols[4]), []).append(cols[11])
+        confidences.append(float(cols[10]))
+    text = "\n".join(" ".join(words) for words in lines.values())
+    return text, sum(confidences) / len(confidences) if confidences else 0.0
+
+
+def prepare_media(
+    data: bytes, mime_type: str, optimize: bool = True, extract_text: bool = True
+) -> list[tuple[bytes, str]]:
+    """
+    Turns a PDF or image into what is sent to the model: the text of PDF pages
+    with a legible text layer and of images OCR reads confidently, as
+    TEXT_MIME_TYPE items, and everything else as images, see `optimize_media`.
+    """
+    if extract_text and mime_type == "application/pdf" and shutil.which("pdftotext"):
+        items = []
+        for number, text in enumerate(pdf_text_pages(data), 1):
+            if _is_legible(text):
+                items.append((text.strip().encode(), TEXT_MIME_TYPE))
+            elif optimize:
+                items.extend(
+                    (page, "image/webp")
+                    for page in _pdf_page_images(
+                        data, first_page=number, last_page=number
+                    )
+                )
+            else:
+                # the model gets the whole PDF once for all pages without text
+                if (data, mime_type) not in items:
+                    items.append((data, mime_type))
+        return items
+
+    if extract_text and mime_type != "application/pdf" and shutil.which("tesseract"):
+        text, confidence = ocr_text(data)
+        if confidence >= OCR_MIN_CONFIDENCE and _is_legible(text):
+            return [(text.encode(), TEXT_MIME_TYPE)]
+
+    return optimize_media(data, mime_type) if optimize else [(data, mime_type)]
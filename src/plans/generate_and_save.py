@@ -1,4 +1,6 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import date
+from functools import partial
 
 import streamlit as st
 from loguru import logger
@@ -8,6 +10,7 @@ from tqdm import tqdm
 
 from src.db import engine
 from src.llm import retry_n_times
+from src.llm_batch import run_batched
 from src.tasks import (
     BaseTask,
     DraggingTask,
@@ -17,7 +20,7 @@ from src.tasks import (
 )
 
 from .plan import ExercisePlan
-from .planning import StudyPlan, TaskCategories
+from .planning import StudyPlan, Task, TaskCategories
 
 category_to_task = {
     TaskCategories.DRAG_AND_DROP: DraggingTask,
@@ -27,40 +30,86 @@ category_to_task = {
 }
 
 
-def generate_and_save(plan: StudyPlan, n_retries=3, timeout=10):
-    db_plan = ExercisePlan(title=plan.title, goal=plan.goal, created_at=date.today())
-
-    generated_tasks_instances: list[BaseTask] = []
-    for i, task_definition in enumerate(
-        tqdm(plan.tasks, desc="Generating task content")
-    ):
-        cls: type[BaseTask] = category_to_task[task_definition.category]
-
-        task_generation_func = retry_n_times(n=n_retries)(
-            cls.generate,
-        )
+def _generate_task(
+    task_definition: Task, n_retries: int, timeout: float
+) -> BaseTask | None:
+    cls: type[BaseTask] = category_to_task[task_definition.category]
 
-        generated_task_instance: BaseTask | None = task_generation_func(
+    task_generation_func = retry_n_times(n=n_retries)(
+        cls.generate,
+    )
+    try:
+        return task_generation_func(
             title=task_definition.title,
             generation_instruction=task_definition.generation_instruction,
             purpose=task_definition.purpose,
             timeout=timeout,
         )
+    except Exception as e:
+        logger.exception(f"Generating {task_definition.title} raised {e}")
+        return None
+
 
-        if generated_task_instance is None:
-            logger.error(
-                f"Failed to generate task content for: {task_definition.title} after {n_retries} retries."
-            )
-            # Optionally, raise an error or decide how to handle partial plan generation
-            raise RuntimeError(
-                f"Could not generate task: {task_definition.title}"
-            )  # Or continue if partial plans are acceptable
+def _generate_concurrently(
+    plan: StudyPlan, n_retries: int, timeout: float, max_concurrency: int
+) -> dict[int, BaseTask | None]:
+    progress_bar = st.progress(0.0) if runtime.exists() else None
+    results: dict[int, BaseTask | None] = {}
+    with ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+        futures = {
+            pool.submit(_generate_task, task_definition, n_retries, timeout): i
+            for i, task_definition in enumerate(plan.tasks)
+        }
+        for future in tqdm(
+            as_completed(futures), total=len(futures), desc="Generating task content"
+        ):
+            results[futures[future]] = future.result()
+            if progress_bar is not None:
+                progress_bar.progress(len(results) / len(plan.tasks))
+    return results
+
+
+def generate_and_save(
+    plan: StudyPlan, n_retries=3, timeout=10, max_concurrency=4, batch=False
+):
+    """
+    Generates the content of all tasks of `plan` concurrently, at most
+    `max_concurrency` at a time, and saves them as a new ExercisePlan.
+    With `batch`, the content is generated by batch jobs instead, see
+    `run_batched`: cheaper, but it can take hours.
+    Tasks that fail are skipped; the plan is only not saved if all of them fail.
+    """
+    db_plan = ExercisePlan(title=plan.title, goal=plan.goal, created_at=date.today())
+
+    if batch:
+        jobs = [
+            partial(_generate_task, task_definition, n_retries, timeout)
+            for task_definition in plan.tasks
+        ]
+        results = dict(enumerate(run_batched(jobs)))
+    else:
+        results = _generate_concurrently(plan, n_retries, timeout, max_concurrency)
 
+    failed = [
+        plan.tasks[i].title for i, task in sorted(results.items()) if task is None
+    ]
+    for title in failed:
+        logger.error(
+            f"Failed to generate task content for: {title} after {n_retries} retries."
+        )
+    # a plan without tasks is saved as an empty plan
+    if failed and len(failed) == len(plan.tasks):
         if runtime.exists():
-            st.progress((i + 1) / len(plan.tasks))
+            st.error("Could not generate any task of the plan. Try again.")
+        raise RuntimeError(f"Could not generate any task of plan {plan.title}")
+    if failed and runtime.exists():
+        st.warning(f"Skipped tasks that could not be generated: {', '.join(failed)}")
 
-        generated_task_instance.position = i
-        generated_tasks_instances.append(generated_task_instance)
+    generated_tasks_instances: list[BaseTask] = [
+        task for _, task in sorted(results.items()) if task is not None
+    ]
+    for position, task_instance in enumerate(generated_tasks_instances):
+        task_instance.position = position
 
     with Session(engine, expire_on_commit=False) as sess:
         sess.add(db_plan)
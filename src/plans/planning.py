@@ -1,14 +1,23 @@
 import os
 from enum import Enum, StrEnum
-from typing import Any, Generator, Optional
+from typing import Any, Callable, Generator, Optional
 
 import streamlit as st
 from google.genai import types
 from loguru import logger
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
 
 from src.config import INITIAL_PROMPT, SOURCE_LANGUAGE, TARGET_LANGUAGE
-from src.llm import gemini_structured_ouput, retry_n_times
+from src.json_stream import JSONStreamParser
+from src.llm import (
+    StreamSource,
+    gemini_stream_async,
+    gemini_structured_ouput,
+    iterate_sync,
+    retry_n_times,
+)
+from src.media import media_registry
+from src.uploads import upload_digest
 
 
 class TaskCategories(StrEnum):
@@ -74,6 +83,13 @@ class StudyPlan(BaseModel):
         os.remove("study_plan.json")
 
 
+class PlanDraft(BaseModel):
+    """A StudyPlan while it is streamed: the reply and the tasks parsed so far."""
+
+    user_message: str = ""
+    tasks: list[Task] = []
+
+
 PLANNER_PROMPT = f"""
 {INITIAL_PROMPT}
 Your job is to help the user plan a new study plan. Listen to what the user wants and create tasks accordingly.
@@ -161,6 +177,10 @@ History_Type = list[tuple[ChatSpeaker, Any]]
 
 def to_gemini_content(history: History_Type) -> list:
     contents = []
+    media_seen = set()
+    media_registry.prefetch_uploads(
+        content for speaker, content in history if speaker == ChatSpeaker.user_media
+    )
 
     for speaker, content in history:
         if speaker == ChatSpeaker.user:
@@ -193,28 +213,89 @@ def to_gemini_content(history: History_Type) -> list:
                 )
             )
         elif speaker == ChatSpeaker.user_media:
-            ext = content.name.split(".")[-1].lower().replace("jpg", "jpeg")
-            content.seek(0)  # fix: reset pointer before reading
-            contents.append(
-                types.Part.from_bytes(
-                    data=content.read(),
-                    mime_type="application/pdf" if ext == "pdf" else f"image/{ext}",
-                )
-            )
-            content.seek(0)  # reset pointer after reading
+            # the same file uploaded twice is only sent once
+            digest = upload_digest(content)
+            if digest not in media_seen:
+                media_seen.add(digest)
+                contents.extend(media_registry.upload_parts(content))
         else:
             raise ValueError("not implemented")
     return contents
 
 
+def stream_plan(
+    history: History_Type,
+    on_draft: Callable[[PlanDraft], None],
+    timeout: float = 15,
+    source: Optional[StreamSource] = None,
+) -> Optional[StudyPlan]:
+    """
+    Streams a new plan, calling `on_draft` whenever the reply grows or a task
+    is complete. Returns the plan, or None if it failed.
+    """
+    parser = JSONStreamParser()
+    draft = PlanDraft()
+    try:
+        for chunk in iterate_sync(
+            gemini_stream_async(
+                PLANNER_PROMPT,
+                to_gemini_content(history),
+                StudyPlan,
+                timeout=timeout,
+                call_site="planner",
+                source=source,
+            )
+        ):
+            completed = parser.feed(chunk)
+            message = parser.partial_string("user_message")
+            changed = message is not None and message != draft.user_message
+            if changed:
+                draft.user_message = message
+
+            for key, item in completed:
+                if key != "tasks":
+                    continue
+                try:
+                    draft.tasks.append(Task.model_validate(item))
+                    changed = True
+                except ValidationError as e:
+                    logger.warning(f"Skipping invalid task in draft - {e}")
+
+            if changed:
+                on_draft(draft)
+        return StudyPlan.model_validate_json(parser.text)
+    except Exception as e:
+        logger.error(f"Streaming the plan failed - {e!r}")
+        return None
+
+
+def _new_plan(
+    history: History_Type,
+    retries: int,
+    on_draft: Optional[Callable[[PlanDraft], None]],
+) -> Optional[StudyPlan]:
+    if on_draft is not None:
+        return retry_n_times(n=retries)(stream_plan)(history, on_draft)
+    return retry_n_times(n=retries)(gemini_structured_ouput)(
+        PLANNER_PROMPT,
+        to_gemini_content(history),
+        StudyPlan,
+        timeout=15,
+        call_site="planner",
+    )
+
+
 def generate_new_plan(
     history: History_Type,
     n_times_critism=1,
     retries=1,
+    on_draft: Optional[Callable[[PlanDraft], None]] = None,
 ) -> Generator[tuple[History_Type, StudyPlan | None], Any, Any]:
-    plan: StudyPlan = retry_n_times(n=retries)(gemini_structured_ouput)(
-        PLANNER_PROMPT, to_gemini_content(history), StudyPlan, timeout=15
-    )
+    """
+    Plans, then lets the critic review the plan `n_times_critism` times.
+    With `on_draft`, plans are streamed and every draft is passed to it.
+    """
+    plan = _new_plan(history, retries, on_draft)
 
     if plan is None:
         history.append(
@@ -231,7 +312,11 @@ def generate_new_plan(
 
     for n in range(n_times_critism):
         criticsm: CriticOutput = retry_n_times(n=retries)(gemini_structured_ouput)(
-            CRITIC_PROMPT, to_gemini_content(history), CriticOutput, timeout=15
+            CRITIC_PROMPT,
+            to_gemini_content(history),
+            CriticOutput,
+            timeout=15,
+            call_site="critic",
         )
 
         if criticsm is None:
@@ -245,9 +330,7 @@ def generate_new_plan(
             continue
 
         history.append((ChatSpeaker.critic_agent, criticsm.criticism))
-        new_plan = retry_n_times(n=retries)(gemini_structured_ouput)(
-            PLANNER_PROMPT, to_gemini_content(history), StudyPlan, timeout=15
-        )
+        new_plan = _new_plan(history, retries, on_draft)
         if new_plan is None:
             history.append(
                 (
@@ -53,6 +53,9 @@ def create_summaries_of_last_plans(
 
     return retry_n_times(n=n_retries)(
         lambda: gemini_text_response(
-            system_prompt=SYSTEM_MESSAGE, contents=contents, model_name=model_name
+            system_prompt=SYSTEM_MESSAGE,
+            contents=contents,
+            model_name=model_name,
+            call_site="summary",
         )
     )
@@ -72,6 +72,7 @@ class DraggingTask(BaseTask, table=True):
             contents=contents,
             Schema=cls.model_json_schema(),
             timeout=timeout,
+            call_site="drag_and_drop",
         )
         return cls(**as_dict)
 
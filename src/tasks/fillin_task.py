@@ -213,5 +213,6 @@ class FillInTask(BaseTask, table=True):
             contents=contents,
             Schema=cls.model_json_schema(),
             timeout=timeout,
+            call_site="fill_in",
         )
         return cls(**as_dict)
@@ -53,7 +53,11 @@ class SentenceOrderTask(BaseModel):
         contents = f"Title: {title}\n\nGeneration Instruction: {generation_instruction}\n\nPurpose: {purpose}"
         # Generate a SentenceOrderTask instance using the LLM
         sentence_order_task = gemini_structured_ouput(
-            system_prompt=system_prompt, contents=contents, Schema=cls, timeout=timeout
+            system_prompt=system_prompt,
+            contents=contents,
+            Schema=cls,
+            timeout=timeout,
+            call_site="sentence_order",
         )
         if sentence_order_task is None:
             return None
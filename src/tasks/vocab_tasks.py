@@ -7,10 +7,10 @@ from loguru import logger
 from pydub import AudioSegment
 from pydub.playback import play
 from sqlmodel import Field, Relationship, Session
-from tqdm import tqdm
 
 from src.anki import AnkiCard, SimpleAnkiCard, update_card
-from src.audio import add_audios_inplance
+from src.audio import add_audios_batch, load_card_audio
+from src.audio_processing import clip_mimetype
 from src.config import INITIAL_PROMPT, LEVEL, SOURCE_LANGUAGE, TARGET_LANGUAGE
 from src.db import engine
 from src.llm import gemini_structured_ouput
@@ -49,12 +49,13 @@ class VocabTask(BaseTask, table=True):
 
         if idx < len(cards):
             card: AnkiCard = cards[idx]
+            a_mp3, b_mp3 = load_card_audio(card)
 
             front = card.b_content if self.b_side_shown else card.a_content
-            front_audio = card.b_mp3 if self.b_side_shown else card.a_mp3
+            front_audio = b_mp3 if self.b_side_shown else a_mp3
 
             back = card.a_content if self.b_side_shown else card.b_content
-            back_audio = card.a_mp3 if self.b_side_shown else card.b_mp3
+            back_audio = a_mp3 if self.b_side_shown else b_mp3
 
             col1, col2 = st.columns([4, 1])
             with col1:
@@ -64,7 +65,7 @@ class VocabTask(BaseTask, table=True):
                 )
             with col2:
                 if front_audio:
-                    st.audio(front_audio, format="audio/mp3")
+                    st.audio(front_audio, format=clip_mimetype(front_audio))
 
             if st.button("Show Answer"):
                 st.session_state.shown = not st.session_state.shown
@@ -78,7 +79,7 @@ class VocabTask(BaseTask, table=True):
                     )
                 with col4:
                     if back_audio:
-                        st.audio(back_audio, format="audio/mp3")
+                        st.audio(back_audio, format=clip_mimetype(back_audio))
             else:
                 # Display an invisible placeholder to keep layout stable
                 st.markdown(
@@ -89,7 +90,7 @@ class VocabTask(BaseTask, table=True):
             if st.button("Submit Rating"):
                 print("submit")
                 if back_audio:
-                    play(AudioSegment.from_file(io.BytesIO(card.a_mp3), format="mp3"))
+                    play(AudioSegment.from_file(io.BytesIO(a_mp3)))
 
                 results.append(rating)
                 st.session_state.current_batch[0] += 1
@@ -233,16 +234,14 @@ class VocabTask(BaseTask, table=True):
             contents=contents,
             Schema=list[SimpleAnkiCard],
             timeout=timeout,
+            call_site="vocab",
         )
         if cards is None:
             return None
 
         try:
-            anki_cards = []
-            for card in tqdm(cards, desc="Generating Anki Cards"):
-                obj = AnkiCard(**card.model_dump())
-                add_audios_inplance(obj)
-                anki_cards.append(obj)
+            anki_cards = [AnkiCard(**card.model_dump()) for card in cards]
+            add_audios_batch(anki_cards)
 
             return cls(cards=anki_cards, title=title)
         except Exception as e:
@@ -0,0 +1,89 @@
+import io
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import NamedTuple
+
+from pdf2image import convert_from_bytes, pdfinfo_from_bytes
+from PIL import Image
+
+from src.media_processing import media_pool
+from src.uploads import upload_digest
+
+THUMBNAIL_WIDTH = (
+    400  # twice the displayed width, for sharp thumbnails on hidpi screens
+)
+MAX_THUMBNAIL_PAGES = 5
+MAX_CACHED_FILES = 64
+
+
+class Thumbnails(NamedTuple):
+    images: list[bytes]
+    n_pages: int
+
+
+def render_thumbnails(
+    data: bytes,
+    is_pdf: bool,
+    width: int = THUMBNAIL_WIDTH,
+    max_pages: int = MAX_THUMBNAIL_PAGES,
+) -> Thumbnails:
+    """JPEG thumbnails of the first `max_pages` pages of a PDF, or of an image."""
+    if is_pdf:
+        n_pages = pdfinfo_from_bytes(data)["Pages"]
+        pages = convert_from_bytes(data, size=(width, None), last_page=max_pages)
+    else:
+        n_pages = 1
+        pages = [Image.open(io.BytesIO(data))]
+        pages[0].thumbnail((width, 4 * width))
+
+    images = []
+    for page in pages:
+        buffer = io.BytesIO()
+        page.convert("RGB").save(buffer, format="JPEG", quality=85)
+        images.append(buffer.getvalue())
+    return Thumbnails(images, n_pages)
+
+
+class ThumbnailCache:
+    """
+    Thumbnails of uploaded files, keyed by content hash. Every file is rendered
+    once on a process pool; reruns get the cached thumbnails.
+    """
+
+    def __init__(self, max_files: int = MAX_CACHED_FILES) -> None:
+        self.max_files = max_files
+        self._futures: OrderedDict[str, Future] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def prefetch(self, files) -> None:
+        """Starts rendering `files`, so several files render in parallel."""
+        for file in files:
+            self._submit(file)
+
+    def get(self, file) -> Thumbnails:
+        future = self._submit(file)
+        try:
+            return future.result()
+        except Exception:
+            # rendered again on the next call
+            with self._lock:
+                self._futures.pop(upload_digest(file), None)
+            raise
+
+    def _submit(self, file) -> Future:
+        digest = upload_digest(file)
+        with self._lock:
+            if digest in self._futures:
+                self._futures.move_to_end(digest)
+                return self._futures[digest]
+            future = media_pool().submit(
+                render_thumbnails, file.getvalue(), file.name.endswith(".pdf")
+            )
+            self._futures[digest] = future
+            while len(self._futures) > self.max_files:
+                self._futures.popitem(last=False)
+            return future
+
+
+thumbnail_cache = ThumbnailCache()
@@ -0,0 +1,85 @@
+import io
+import os
+import shutil
+import subprocess
+from functools import cache
+from typing import Optional, Protocol
+
+from gtts import gTTS
+from pydub import AudioSegment
+
+
+class TTSBackend(Protocol):
+    """
+    A text-to-speech engine returning mp3 bytes.
+    `max_workers` and `max_per_second` tell the batch synthesis how hard the
+    backend may be driven; `name` is part of every clip key.
+    """
+
+    name: str
+    max_workers: int
+    max_per_second: Optional[float]
+
+    def synthesize(
+        self, text: str, lang: str, timeout: Optional[float] = None
+    ) -> bytes: ...
+
+
+class GTTSBackend:
+    """Google Translate TTS. Needs network access, bound by request latency."""
+
+    name = "gtts"
+    max_workers = 8
+    max_per_second = 8
+
+    def synthesize(
+        self, text: str, lang: str, timeout: Optional[float] = None
+    ) -> bytes:
+        mp3_bytes = io.BytesIO()
+        gTTS(text, lang=lang, timeout=timeout).write_to_fp(mp3_bytes)
+        return mp3_bytes.getvalue()
+
+
+class EspeakBackend:
+    """Local espeak-ng. Works offline, bound by CPU."""
+
+    name = "espeak-ng"
+    max_workers = os.cpu_count() or 4
+    max_per_second = None
+
+    def __init__(self, executable: str = "espeak-ng"):
+        path = shutil.which(executable)
+        if path is None:
+            raise RuntimeError(f"{executable} is not installed")
+        self._executable = path
+
+    def synthesize(
+        self, text: str, lang: str, timeout: Optional[float] = None
+    ) -> bytes:
+        wav = subprocess.run(
+            [self._executable, "-v", lang, "--stdout", text],
+            capture_output=True,
+            check=True,
+            timeout=timeout,
+        ).stdout
+        mp3_bytes = io.BytesIO()
+        AudioSegment.from_wav(io.BytesIO(wav)).export(mp3_bytes, format="mp3")
+        return mp3_bytes.getvalue()
+
+
+BACKENDS: dict[str, type[TTSBackend]] = {
+    GTTSBackend.name: GTTSBackend,
+    EspeakBackend.name: EspeakBackend,
+}
+
+
+@cache
+def get_backend(name: Optional[str] = None) -> TTSBackend:
+    """
+    Returns the backend `name`, by default the one selected by the TTS_BACKEND
+    environment variable (gtts if unset).
+    """
+    name = name or os.environ.get("TTS_BACKEND", GTTSBackend.name)
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown TTS backend {name}, choose from {list(BACKENDS)}")
+    return BACKENDS[name]()
@@ -0,0 +1,27 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+# as many as the thumbnail cache keeps
+MAX_HASHED_UPLOADS = 64
+
+# hashes of streamlit uploads by file id, so every upload is only hashed once;
+# the least recently used are dropped
+_upload_hashes: OrderedDict[str, str] = OrderedDict()
+_lock = threading.Lock()
+
+
+def upload_digest(file) -> str:
+    """Content hash of a streamlit UploadedFile."""
+    file_id = getattr(file, "file_id", None) or file.name
+    with _lock:
+        if file_id in _upload_hashes:
+            _upload_hashes.move_to_end(file_id)
+            return _upload_hashes[file_id]
+    # hashed outside the lock, a large upload does not block the others
+    digest = hashlib.sha256(file.getvalue()).hexdigest()
+    with _lock:
+        _upload_hashes[file_id] = digest
+        while len(_upload_hashes) > MAX_HASHED_UPLOADS:
+            _upload_hashes.popitem(last=False)
+    return digest
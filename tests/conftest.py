@@ -0,0 +1,21 @@
+import pytest
+from sqlmodel import create_engine
+
+import src.db as db
+import src.llm as llm
+import src.llm_budget as llm_budget
+import src.llm_cache as llm_cache
+import src.llm_telemetry as llm_telemetry
+import src.tasks  # noqa: F401, registers the task tables the cards refer to
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """A fresh database for the LLM layer."""
+    engine = create_engine(f"sqlite:///{tmp_path / 'db.sqlite'}")
+    for module in (db, llm, llm_budget, llm_cache, llm_telemetry):
+        monkeypatch.setattr(module, "engine", engine)
+    db.init_db()
+    yield engine
+    # writes the buffered LLMCall rows while the engine is still patched
+    llm.usage_writer.flush()
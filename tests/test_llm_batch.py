@@ -0,0 +1,78 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+from google.genai import types
+from pydantic import BaseModel
+
+import src.llm as llm
+import src.llm_batch as llm_batch
+
+
+class Answer(BaseModel):
+    answer: str
+
+
+@pytest.fixture
+def batch(database, tmp_path, monkeypatch):
+    """A fresh database and batch directory, and a fake Gemini backend."""
+    batch = SimpleNamespace(dir=tmp_path / "batch_jobs", calls=0)
+
+    async def generate_content(model_name, config, contents, timeout):
+        batch.calls += 1
+        return types.GenerateContentResponse(
+            candidates=[
+                types.Candidate(
+                    content=types.Content(
+                        role="model",
+                        parts=[
+                            types.Part(text=Answer(answer="hola").model_dump_json())
+                        ],
+                    )
+                )
+            ]
+        )
+
+    monkeypatch.setattr(llm_batch, "_generate_content", generate_content)
+    monkeypatch.setattr(llm, "_generate_content", generate_content)
+    monkeypatch.setattr(llm_batch, "BATCH_DIR", batch.dir)
+    return batch
+
+
+def _batch_files(batch) -> list:
+    # the request files, without the .results.jsonl files
+    return [
+        path for path in batch.dir.glob("*.jsonl") if ".results" not in path.suffixes
+    ]
+
+
+def _ask() -> Answer:
+    return llm.gemini_structured_ouput("system", "question", Answer, call_site="vocab")
+
+
+def test_identical_jobs_share_one_batch_request(batch):
+    assert llm_batch.run_batched([_ask, _ask], mode="local") == [
+        Answer(answer="hola"),
+        Answer(answer="hola"),
+    ]
+    (batch_file,) = _batch_files(batch)
+    assert len(batch_file.read_text().splitlines()) == 1
+    assert batch.calls == 1
+
+    # the rerun is answered from the response cache, without a new batch
+    assert llm_batch.run_batched([_ask, _ask], mode="local") == [
+        Answer(answer="hola"),
+        Answer(answer="hola"),
+    ]
+    assert batch.calls == 1
+    assert _batch_files(batch) == [batch_file]
+
+
+def test_batch_lines_are_generate_content_requests(batch):
+    llm_batch.run_batched([_ask], mode="local")
+    (batch_file,) = _batch_files(batch)
+    line = json.loads(batch_file.read_text())
+    request = line["request"]
+    assert request["contents"] == [{"role": "user", "parts": [{"text": "question"}]}]
+    assert request["system_instruction"] == {"parts": [{"text": "system"}]}
+    assert request["generation_config"]["response_mime_type"] == "application/json"
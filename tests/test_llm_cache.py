@@ -0,0 +1,47 @@
+from types import SimpleNamespace
+
+import pytest
+from pydantic import BaseModel
+
+import src.llm as llm
+
+
+class Answer(BaseModel):
+    answer: str
+
+
+@pytest.fixture
+def backend(database, monkeypatch):
+    """A fresh database, and a fake Gemini backend answering with `answers` in turn."""
+    backend = SimpleNamespace(answers=[], calls=0)
+
+    async def generate_content(model_name, config, contents, timeout):
+        answer = backend.answers[min(backend.calls, len(backend.answers) - 1)]
+        backend.calls += 1
+        return SimpleNamespace(text=Answer(answer=answer).model_dump_json())
+
+    monkeypatch.setattr(llm, "_generate_content", generate_content)
+    return backend
+
+
+def test_identical_requests_are_answered_from_the_cache(backend):
+    backend.answers = ["hola"]
+    first = llm.gemini_structured_ouput("system", "question", Answer)
+    second = llm.gemini_structured_ouput("system", "question", Answer)
+    assert first == second == Answer(answer="hola")
+    assert backend.calls == 1
+
+
+def test_retries_reach_the_backend(backend):
+    backend.answers = ["wrong", "right"]
+
+    @llm.retry_n_times(n=3)
+    def generate():
+        answer = llm.gemini_structured_ouput("system", "question", Answer)
+        return answer if answer.answer == "right" else None
+
+    assert generate() == Answer(answer="right")
+    assert backend.calls == 2
+    # the accepted answer replaced the rejected one in the cache
+    assert llm.gemini_structured_ouput("system", "question", Answer).answer == "right"
+    assert backend.calls == 2
@@ -0,0 +1,44 @@
+from datetime import datetime, timedelta
+
+from sqlmodel import Session
+
+from src.llm_telemetry import CallOutcome, LLMCall, latency_report
+
+
+def test_latency_report_covers_the_window(database):
+    now = datetime.now()
+    calls = [
+        LLMCall(call_site="vocab", wall_time_ms=ms, started_at=now)
+        for ms in range(1, 101)
+    ] + [
+        LLMCall(call_site="vocab", outcome=CallOutcome.timeout, attempt=2),
+        LLMCall(call_site="vocab", outcome=CallOutcome.cache_hit, wall_time_ms=0),
+        LLMCall(call_site="planner", wall_time_ms=500),
+        # before the window
+        LLMCall(call_site="critic", wall_time_ms=7, started_at=now - timedelta(days=2)),
+    ]
+    with Session(database) as sess:
+        for call in calls:
+            call.model_name = "gemini-2.0-flash"
+            call.started_at = call.started_at or now
+            sess.add(call)
+        sess.commit()
+
+    planner, vocab = latency_report(now - timedelta(days=1))
+
+    assert planner == {
+        "call_site": "planner",
+        "calls": 1,
+        "cache_hits": 0,
+        "failure_rate": 0.0,
+        "retries": 0,
+        "p50_ms": 500,
+        "p95_ms": 500,
+        "p99_ms": 500,
+    }
+    assert vocab["calls"] == 101
+    assert vocab["cache_hits"] == 1
+    assert vocab["failure_rate"] == 1 / 101
+    assert vocab["retries"] == 1
+    # the timeout took 0 ms
+    assert (vocab["p50_ms"], vocab["p95_ms"], vocab["p99_ms"]) == (50, 95, 99)
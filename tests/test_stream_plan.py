@@ -0,0 +1,83 @@
+import json
+
+import pytest
+
+from src.json_stream import JSONStreamParser
+from src.llm import local_stream
+from src.plans.planning import ChatSpeaker, StudyPlan, stream_plan
+
+PLAN = StudyPlan(
+    user_message='Here is your plan: "Día 1" \\ repaso\n¡Vamos! 😀 {not: [json]}',
+    title="Ser y estar",
+    goal="Tell ser and estar apart",
+    tasks=[
+        {
+            "category": "fill_in",
+            "title": "Ser o estar",
+            "generation_instruction": 'Sentences like "Yo ___ cansado", escape \\n',
+            "purpose": "Practice the forms",
+        },
+        {
+            "category": "vocab",
+            "title": "Adjetivos",
+            "generation_instruction": "Adjectives that change meaning: {listo, malo}",
+            "purpose": "Learn the meanings",
+        },
+    ],
+)
+# as the model may stream it, with \u escapes and whitespace
+PLAN_JSON = json.dumps(PLAN.model_dump(mode="json"), indent=2, ensure_ascii=True)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 5, 16, len(PLAN_JSON)])
+def test_stream_plan_drafts_grow_into_the_plan(database, chunk_size):
+    drafts = []
+    plan = stream_plan(
+        [(ChatSpeaker.user, "A plan for ser and estar")],
+        lambda draft: drafts.append(draft.model_copy(deep=True)),
+        source=local_stream(PLAN_JSON, chunk_size=chunk_size, delay=0),
+    )
+
+    assert plan == PLAN
+    assert drafts[-1].user_message == PLAN.user_message
+    assert drafts[-1].tasks == PLAN.tasks
+    for before, after in zip(drafts, drafts[1:]):
+        assert after.user_message.startswith(before.user_message)
+        assert after.tasks[: len(before.tasks)] == before.tasks
+    for draft in drafts:
+        assert PLAN.user_message.startswith(draft.user_message)
+    if chunk_size < len(PLAN.user_message):
+        # the reply is shown while it is streamed
+        assert any(
+            draft.user_message and draft.user_message != PLAN.user_message
+            for draft in drafts
+        )
+
+
+def test_stream_plan_fails_on_a_truncated_plan(database):
+    plan = stream_plan(
+        [(ChatSpeaker.user, "A plan for ser and estar")],
+        lambda draft: None,
+        source=local_stream(PLAN_JSON[: len(PLAN_JSON) // 2], delay=0),
+    )
+    assert plan is None
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7])
+def test_parser_collects_nested_items_and_fields(chunk_size):
+    value = {
+        "message": 'a "b" \\ c é \U0001f600',
+        "items": [{"nested": {"list": [1, [2, "]"]]}}, "}", 3.5, True, None],
+        "count": -12,
+        "empty": [],
+        "flag": False,
+    }
+    text = json.dumps(value, ensure_ascii=True)
+    parser = JSONStreamParser()
+    completed = []
+    for start in range(0, len(text), chunk_size):
+        completed += parser.feed(text[start : start + chunk_size])
+
+    assert completed == [("items", item) for item in value["items"]]
+    assert parser.items["items"] == value["items"]
+    assert parser.fields == value
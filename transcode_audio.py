@@ -0,0 +1,18 @@
+"""
+Trims, normalizes and transcodes every unprocessed clip in the audio store to opus.
+
+    python transcode_audio.py --max-workers 4
+"""
+
+import argparse
+
+from src.audio import transcode_store
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--max-workers", type=int, default=None)
+    args = parser.parse_args()
+
+    before, after = transcode_store(max_workers=args.max_workers)
+    saved = 1 - after / before if before else 0
+    print(f"{before / 1024:.1f} KiB -> {after / 1024:.1f} KiB ({saved:.0%} smaller)")